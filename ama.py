@@ -38,6 +38,9 @@ subject disappears into the shelter.
             
 2) Right mouse click : Set the tail tag location 
 - Deletion function is as same as left mouse click.
+A clicked position is propagated; neighbouring frames (up to 300 frames 
+forward and backward) are tracked again from it, until the results 
+are the same as before or another clicked/deleted frame is reached.
 
 3) Left arrow key : Move to previous frame (-1)
 4) Shift + Left : Move to a frame (-60; one second)
@@ -56,8 +59,26 @@ subject disappears into the shelter.
 14) Shift + L : Increase width of ‘rect’
 15) Shift + I : Reduce height of ‘rect’
 16) Shift + K : Increase height of ‘rect’
+
+17) Cmd + G : Interpolate tag positions over short gaps 
+(up to 15 frames) of failed detections in the whole session.
+Interpolated positions are drawn as outlined squares.
+User's deletions ('D') are never overwritten.
 '''
 
+import sys
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] in ['--batch', '--export']:
+    ### headless runs (tracking of session folders or rebuilding annotated videos); wx is not imported
+    from modules.base_funcs import GNU_notice
+    GNU_notice(0)
+    if sys.argv[1] == '--batch':
+        from modules.batch_proc import run_batch
+        run_batch(sys.argv[2:])
+    else:
+        from modules.video_export import run_export
+        run_export(sys.argv[2:])
+    sys.exit(0)
+
 import Queue, plistlib
 from threading import Thread
 from os import getcwd, path
@@ -71,8 +92,11 @@ from random import shuffle
 import wx
 import numpy as np
 
-from modules.misc_funcs import GNU_notice, get_time_stamp, writeFile, show_msg, load_img, cvImg_to_wxBMP, calc_angle_diff  
-from modules.cv_proc import CVProc
+from modules.misc_funcs import GNU_notice, get_time_stamp, writeFile, show_msg, load_img, BMPRenderer, calc_angle_diff  
+from modules.cv_proc import CVProc, blue_ht_sessions
+from modules.session_data import load_result, save_result, compact_result, ST_MANUAL
+from modules.stage_timer import StageTimer
+from modules.frame_src import FramePrefetcher, FrameCache, PreviewStore, open_frame_src, get_result_base, get_video_out_path, video_exts
 
 # ======================================================
 
@@ -91,22 +115,41 @@ class AMAFrame(wx.Frame):
         self.program_start_time = time()
         self.session_start_time = -1
         self.oData = {} # output data
-        self.fPath = '' # folder path including frame images
+        self.fPath = '' # base path of the session (frame folder path, or video file path without its extension)
         self.sString = '' # session string such as '287_Sh_1', '289_NE_1', and so on..
-        self.blue_ht_sessions = ['286_Sh_2', '287_NE_2', '288_Sh_2', '289_Sh_2', '290_Sh_2', '291_Sh_1', '292_Sh_1', '293_Sh_1', '294_Sh_1', '295_NE_1', '296_NE_1', '297_Sh_1', '298_Sh_2', '299_Sh_1', '300_NE_1', '301_NE_1', '302_NE_2', '303_NE_2', '304_NE_2', '305_NE_2', '306_Sh_0', '306_Sh_1', '307_Sh_1'] # head tag color is blue in these sessions (red in others)
+        self.blue_ht_sessions = blue_ht_sessions # head tag color is blue in these sessions (red in others)
         self.fi = 0 # current frame index
         self.frame_cnt = 0
         self.vFPS = 60 # fps for video file
         self.tagSz = 10 # head/tail_base tag size (length of one edge of square shape)
         self.is_running = False # analysis is running by pressing spacebar
-        self.timer_run = None # timer for running analysis
+        self.run_th = None # thread for running analysis; tracks frames one after another
+        self.run_flag = False # run_th keeps tracking while this is True
+        self.latest = None # (frame index, decoded frame, annotated frame) tracked last in run_th
+        self.disp_fi = 0 # index of the frame being displayed; it can be behind self.fi during continuous analysis
+        self.disp_intv = 1000/15 # interval (ms) for displaying the latest frame during continuous analysis
+        self.frame_src = None # FolderSource or VideoSource
+        self.prefetcher = None # decodes upcoming frames in background
+        self.frame_cache = FrameCache(max_mb=512) # decoded/annotated frames, recently displayed
+        self.preview = None # downscaled preview images, shown during rapid jumps
+        self.settle_delay = 300 # full resolution processing starts after no more jumps for this duration (ms)
+        self.timer_settle = None # timer for processing a frame after jumps
+        self.is_preview = False # preview image is being displayed
+        self.autosave_intv = 30 # interval (seconds) for compacting the edit journal into the autosave file
+        self.last_autosave_time = -1
+        self.autosave_th = None # thread for compacting the edit journal
+        self.stage_timer = StageTimer() # durations of frame pipeline stages
+        self.show_timing = False # show summary of stage durations in the status bar
+        self.last_timing_time = -1
+        self.max_gap = 15 # runs of failed detections up to this number of frames are interpolated with Cmd+G
+        self.max_propagate = 300 # a manual correction is propagated up to this number of frames forward and backward
 
         ### user interface setup
         posX = 5
         posY = 10
         btn_width = 150
         b_space = 30
-        self.btn_start = wx.Button(self.panel, -1, label='Analyze video (folder)', pos=(posX,posY), size=(btn_width, -1))
+        self.btn_start = wx.Button(self.panel, -1, label='Analyze video', pos=(posX,posY), size=(btn_width, -1))
         self.btn_start.Bind(wx.EVT_LEFT_UP, self.onStartStopAnalyzeVideo)
         posY += b_space
         self.btn_quit = wx.Button(self.panel, -1, label='QUIT', pos=(posX,posY), size=(btn_width, -1))
@@ -155,6 +198,8 @@ class AMAFrame(wx.Frame):
         self.loaded_img.Bind(wx.EVT_ERASE_BACKGROUND, lambda evt: None) 
         self.loaded_img.Bind(wx.EVT_LEFT_UP, self.onMouseLeftUp)
         self.loaded_img.Bind(wx.EVT_RIGHT_UP, self.onMouseRightUp)
+        disp_max_size = ( self.w_size[0]-10, wx.GetDisplaySize()[1]-self.loaded_img_pos[1]-100 ) # frames larger than this are displayed downscaled
+        self.renderer = BMPRenderer(disp_max_size) # renders frames into a reusable bitmap
         
         statbar = wx.StatusBar(self, -1)
         self.SetStatusBar(statbar)
@@ -168,6 +213,8 @@ class AMAFrame(wx.Frame):
         moveRectUp_btnId = wx.NewId(); moveRectDown_btnId = wx.NewId(); moveRectLeft_btnId = wx.NewId(); moveRectRight_btnId = wx.NewId() # p_rect of cv_proc
         resizeRectUp_btnId = wx.NewId(); resizeRectDown_btnId = wx.NewId(); resizeRectLeft_btnId = wx.NewId(); resizeRectRight_btnId = wx.NewId()
         space_btnId = wx.NewId() 
+        timing_btnId = wx.NewId()
+        fillGaps_btnId = wx.NewId()
         self.Bind(wx.EVT_MENU, self.onClose, id = exit_btnId)
         self.Bind(wx.EVT_MENU, self.onSave, id = save_btnId)
         self.Bind(wx.EVT_MENU, lambda event: self.onLeft(event, 'left'), id=left_btnId)
@@ -185,8 +232,12 @@ class AMAFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, lambda event: self.onAdjustRect(event, 's_up'), id=resizeRectUp_btnId)
         self.Bind(wx.EVT_MENU, lambda event: self.onAdjustRect(event, 's_down'), id=resizeRectDown_btnId)
         self.Bind(wx.EVT_MENU, self.onSpace, id = space_btnId)
+        self.Bind(wx.EVT_MENU, self.onToggleTiming, id = timing_btnId)
+        self.Bind(wx.EVT_MENU, self.onFillGaps, id = fillGaps_btnId)
         accel_tbl = wx.AcceleratorTable([ (wx.ACCEL_CMD,  ord('Q'), exit_btnId ), 
                                           (wx.ACCEL_CMD,  ord('S'), save_btnId ),
+                                          (wx.ACCEL_CMD,  ord('T'), timing_btnId ),
+                                          (wx.ACCEL_CMD,  ord('G'), fillGaps_btnId ),
                                           (wx.ACCEL_NORMAL,  wx.WXK_RIGHT, right_btnId ), 
                                           (wx.ACCEL_NORMAL,  wx.WXK_LEFT, left_btnId ), 
                                           (wx.ACCEL_SHIFT,  wx.WXK_RIGHT, rightJump_btnId ), 
@@ -208,6 +259,8 @@ class AMAFrame(wx.Frame):
         self.timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.onTimer, self.timer)
         self.timer.Start(100)
+        self.timer_disp = wx.Timer(self) # displays frames during continuous analysis
+        self.Bind(wx.EVT_TIMER, self.onDispTimer, self.timer_disp)
 
         self.Bind( wx.EVT_CLOSE, self.onClose )
 
@@ -242,7 +295,8 @@ class AMAFrame(wx.Frame):
         if flag == 'left': self.fi -= 1
         elif flag == 'leftjump': self.fi = max(1, self.fi-self.vFPS)
         elif flag == 'leftjumpfurther': self.fi = max(1, self.fi-1000)
-        self.proc_img()
+        if flag == 'left': self.proc_img()
+        else: self.show_preview()
 
     # --------------------------------------------------       
     
@@ -251,19 +305,14 @@ class AMAFrame(wx.Frame):
         '''
         if self.fPath == '' or self.fi >= self.frame_cnt: return
         if self.is_running == True: # if continuous analysis is running 
-            ### FPS update
-            self.fps += 1
-            if time()-self.last_fps_time >= 1:
-                self.sTxt_fps.SetLabel( "FPS: %i"%(self.fps) )
-                self.fps = 0
-                self.last_fps_time = time()
             if event != None: # user pressed this manual navigation key
                 self.onSpace(None) # stop continuous analysis
         if flag == 'right': self.fi += 1
         elif flag == 'rightjump': self.fi = min(self.frame_cnt, self.fi+self.vFPS)
         elif flag == 'rightjumpfurther': self.fi = min(self.frame_cnt, self.fi+1000) 
         if self.fi == self.frame_cnt and self.is_running == True: self.onSpace(None)
-        self.proc_img()
+        if flag == 'right': self.proc_img()
+        else: self.show_preview()
 
     #------------------------------------------------
     
@@ -273,55 +322,143 @@ class AMAFrame(wx.Frame):
         if self.fPath == '' or self.fi > self.frame_cnt: return
         if self.is_running == False:
             self.is_running = True
-            self.fps = 0
-            self.last_fps_time = time()
-            self.timer_run = wx.FutureCall(1, self.onRight, None, 'right')
+            self.start_run()
         else:
-            try: # stop timer
-                self.timer_run.Stop() 
-                self.timer_run = None
-            except: pass
+            self.pause_run()
             self.sTxt_fps.SetLabel('')
             self.is_running = False # stop continuous analysis
+
+    #------------------------------------------------
+
+    def start_run(self):
+        ''' start tracking the following frames in run_th
+        '''
+        if self.timer_settle != None: # frame after jumps is not processed yet
+            self.proc_img() # process it first; proc_img calls start_run again, if tags are found
+            return
+        self.run_flag = True
+        self.latest = None
+        self.fps = 0 # frames tracked since last_fps_time
+        self.last_fps_time = time()
+        self.run_th = Thread(target=self.run_analysis)
+        self.run_th.start()
+        self.timer_disp.Start(self.disp_intv)
+
+    #------------------------------------------------
+
+    def run_analysis(self):
+        ''' track frames one after another, as fast as possible,
+        until a tag is not found properly, the last frame is reached or run_flag is off.
+        display is done separately by onDispTimer.
+        '''
+        while self.run_flag == True and self.fi < self.frame_cnt:
+            img = self.prefetcher.get(self.fi+1)
+            self.fi += 1
+            rIMG, rTP, h2ac_dist = self.cv_proc.proc_img(img.copy())
+            self.oData.set(self.fi, 'hPos', rTP[0], self.cv_proc.tag_st[0])
+            self.oData[self.fi]['h2ac_dist'] = h2ac_dist
+            self.oData.set(self.fi, 'tbPos', rTP[1], self.cv_proc.tag_st[1])
+            self.latest = (self.fi, img, rIMG)
+            self.fps += 1
+            if -1 in [rTP[0][0], rTP[0][1], rTP[1][0], rTP[1][1]]: break # stop here for user's correction
+
+    #------------------------------------------------
+
+    def onDispTimer(self, event):
+        ''' display the latest tracked frame during continuous analysis
+        '''
+        if self.run_th == None: return
+        self.show_latest()
+        if time()-self.last_fps_time >= 1:
+            self.sTxt_fps.SetLabel( "FPS: %i"%(self.fps/(time()-self.last_fps_time)) )
+            self.fps = 0
+            self.last_fps_time = time()
+        if self.run_th.isAlive() == False: # run_th stopped by itself
+            self.pause_run()
+            if self.fi >= self.frame_cnt: self.onSpace(None) # reached the last frame
+            # otherwise, a tag was not found; is_running stays True and analysis continues after user's correction
+
+    #------------------------------------------------
+
+    def show_latest(self):
+        ''' display and cache the frame tracked last in run_th
+        '''
+        if self.latest == None: return
+        fi, img, rIMG = self.latest
+        self.latest = None
+        self.frame_cache.put(fi, dict( img=img, rIMG=rIMG, sig=self.get_frame_sig(fi) ), img.nbytes + rIMG.nbytes)
+        self.display(rIMG, fi)
+
+    #------------------------------------------------
+
+    def pause_run(self):
+        ''' stop run_th (if it's running) and display the last tracked frame
+        '''
+        if self.run_th == None: return
+        self.run_flag = False
+        self.run_th.join()
+        self.run_th = None
+        self.timer_disp.Stop()
+        self.show_latest()
             
     #------------------------------------------------
     
     def onMouseLeftUp(self, event):
-        if self.fPath == '': return
-        mp = event.GetPosition()
+        if self.fPath == '' or self.disp_fi < 1: return
+        fi = self.disp_fi # correction is for the frame, which the user sees; run_th might be ahead of it
+        self.pause_run()
+        self.fi = fi
+        mp = self.renderer.to_frame_coord( event.GetPosition() ) # displayed image can be downscaled
         p_ = self.oData[self.fi]['hPos']
         if p_ == (None,None) or p_ == ('D','D'): # position info is not determined or intentionally deleted 
-            self.oData[self.fi]['hPos'] = (mp[0], mp[1])
+            self.oData.set(self.fi, 'hPos', (mp[0], mp[1]), ST_MANUAL)
         else:
             r_ = (p_[0]-self.tagSz/2, p_[1]-self.tagSz/2, p_[0]+self.tagSz/2, p_[1]+self.tagSz/2) # x1,y1,x2,y2
             if r_[0] <= mp[0] <= r_[2] and r_[1] <= mp[1] <= r_[3]: # mouse clicked in the tag area
                 self.oData[self.fi]['hPos'] = ('D','D') # delete info
             else:
-                self.oData[self.fi]['hPos'] = (mp[0], mp[1])
+                self.oData.set(self.fi, 'hPos', (mp[0], mp[1]), ST_MANUAL)
+        self.propagate_correction('hPos')
         self.proc_img()
 
     #------------------------------------------------
  
     def onMouseRightUp(self, event):
-        if self.fPath == '': return
-        mp = event.GetPosition()
+        if self.fPath == '' or self.disp_fi < 1: return
+        fi = self.disp_fi # correction is for the frame, which the user sees; run_th might be ahead of it
+        self.pause_run()
+        self.fi = fi
+        mp = self.renderer.to_frame_coord( event.GetPosition() ) # displayed image can be downscaled
         p_ = self.oData[self.fi]['tbPos']
         if p_ == (None,None) or p_ == ('D','D'): # position info is not determined or intentionally deleted 
-            self.oData[self.fi]['tbPos'] = (mp[0], mp[1])
+            self.oData.set(self.fi, 'tbPos', (mp[0], mp[1]), ST_MANUAL)
         else:
             r_ = (p_[0]-self.tagSz/2, p_[1]-self.tagSz/2, p_[0]+self.tagSz/2, p_[1]+self.tagSz/2) # x1,y1,x2,y2
             if r_[0] <= mp[0] <= r_[2] and r_[1] <= mp[1] <= r_[3]: # mouse clicked in the tag area
                 self.oData[self.fi]['tbPos'] = ('D','D') # delete info
             else:
-                self.oData[self.fi]['tbPos'] = (mp[0], mp[1])
+                self.oData.set(self.fi, 'tbPos', (mp[0], mp[1]), ST_MANUAL)
+        self.propagate_correction('tbPos')
         self.proc_img()
 
     #------------------------------------------------
+
+    def propagate_correction(self, tag_key):
+        ''' re-track neighbouring frames from the tag position, which the user just set
+        '''
+        if self.oData.status[tag_key][self.fi] != ST_MANUAL: return # deleted
+        wx.BeginBusyCursor()
+        changed = self.cv_proc.propagate(self.fi, tag_key, self.prefetcher.load, self.max_propagate)
+        wx.EndBusyCursor()
+        if len(changed) > 0: self.show_msg_in_statbar('Correction propagated to %i frames (%i ~ %i)'%(len(changed), min(changed), max(changed)))
+
+    #------------------------------------------------
     
     def onAdjustRect(self, event, flag):
         '''Adjusting p_rect of cv_proc, which defines 
         the rect (x1,y1,x2,y2) of bottom box paper panel
         '''
+        self.pause_run()
         if flag == 'm_left': self.cv_proc.p_rect[0] -= 1; self.cv_proc.p_rect[2] -= 1 # move left
         elif flag == 'm_right': self.cv_proc.p_rect[0] += 1; self.cv_proc.p_rect[2] += 1 # move right
         elif flag == 'm_up': self.cv_proc.p_rect[1] -= 1; self.cv_proc.p_rect[3] -= 1 # move up
@@ -334,140 +471,162 @@ class AMAFrame(wx.Frame):
     
     #------------------------------------------------
     
+    def show_preview(self):
+        ''' after a jump, display the preview image of the frame
+        and process it in full resolution only when the user settles on it
+        '''
+        if self.fPath == '': return
+        cached = self.frame_cache.get(self.fi)
+        if cached != None and cached['sig'] == self.get_frame_sig(self.fi): # already processed; cheap to display
+            self.proc_img()
+            return
+        pImg = self.preview.get(self.fi)
+        if pImg is not None:
+            self.display(pImg, self.fi)
+            self.SetStatusText('Preview of frame %i'%(self.fi))
+            self.is_preview = True
+        if self.timer_settle != None: self.timer_settle.Stop()
+        self.timer_settle = wx.FutureCall(self.settle_delay, self.proc_img)
+
+    #------------------------------------------------
+    
     def proc_img(self):
         if self.fPath == '': return
-        fp = path.join(self.fPath, 'f%06i.jpg'%self.fi)
-        img = load_img(fp, flag='cv')
-        rIMG, rTP, h2ac_dist = self.cv_proc.proc_img(img) # cv_proc.proc_img returns image, tag positions (head & tail-base), head-to-center distance
-        self.loaded_img.SetBitmap( cvImg_to_wxBMP(rIMG) ) # display image
-        #if rTP[0] != (-1, -1): # if it's not (-1,-1), update head tag position of the output data
-        self.oData[self.fi]['hPos'] = rTP[0]
-        self.oData[self.fi]['h2ac_dist'] = h2ac_dist
-        #if rTP[1] != (-1, -1): # if it's not (-1,-1), update tail tag position of the output data
-        self.oData[self.fi]['tbPos'] = rTP[1] 
-        if self.is_running == True:
+        self.pause_run() # frames are processed in one thread at a time
+        if self.timer_settle != None: # processing after jumps is not necessary anymore
+            self.timer_settle.Stop()
+            self.timer_settle = None
+        if self.is_preview == True:
+            self.SetStatusText('')
+            self.is_preview = False
+        cached = self.frame_cache.get(self.fi)
+        if cached != None and cached['sig'] == self.get_frame_sig(self.fi): # nothing changed since the frame was processed
+            self.prefetcher.move(self.fi)
+            self.cv_proc.video_rec.write(cached['rIMG'])
+            rTP = [ self.oData[self.fi]['hPos'], self.oData[self.fi]['tbPos'] ]
+        else:
+            if cached != None: img = cached['img'] # decoded frame
+            else: img = self.prefetcher.get(self.fi)
+            rIMG, rTP, h2ac_dist = self.cv_proc.proc_img(img.copy()) # cv_proc.proc_img returns image, tag positions (head & tail-base), head-to-center distance
+            #if rTP[0] != (-1, -1): # if it's not (-1,-1), update head tag position of the output data
+            self.oData.set(self.fi, 'hPos', rTP[0], self.cv_proc.tag_st[0])
+            self.oData[self.fi]['h2ac_dist'] = h2ac_dist
+            #if rTP[1] != (-1, -1): # if it's not (-1,-1), update tail tag position of the output data
+            self.oData.set(self.fi, 'tbPos', rTP[1], self.cv_proc.tag_st[1])
+            cached = dict( img=img, rIMG=rIMG, sig=self.get_frame_sig(self.fi) )
+            self.frame_cache.put(self.fi, cached, img.nbytes + rIMG.nbytes)
+        self.display(cached['rIMG'], self.fi) # display image
+        if self.is_running == True and self.run_th == None:
             if -1 not in [rTP[0][0], rTP[0][1], rTP[1][0], rTP[1][1]]: # all head and tail tag information were returned properly
                 if self.fi < self.frame_cnt: # there's more frames to run
-                    self.timer_run = wx.FutureCall(1, self.onRight, None, 'right') # keep continuous analysis
+                    self.start_run() # keep continuous analysis
+
+    #------------------------------------------------
+
+    def display(self, cvImg, fi):
+        ''' display an OpenCV image of a frame ('fi') in the frame image area
+        '''
+        self.disp_fi = fi
+        t0 = time()
+        bmp = self.renderer.render(cvImg)
+        t0 = self.stage_timer.add('bitmap', t0)
+        self.loaded_img.SetBitmap(bmp)
+        self.stage_timer.add('display', t0)
+
+    #------------------------------------------------
+
+    def get_frame_sig(self, fi):
+        ''' returns what the annotation of a frame depends on;
+        tag positions, their status codes (e.g. interpolated tags are drawn as outlines), 
+        distance and the arena rect
+        '''
+        fd = self.oData[fi]
+        st_ = ( int(self.oData.status['hPos'][fi]), int(self.oData.status['tbPos'][fi]) )
+        return ( fd['hPos'], fd['tbPos'], st_, fd['h2ac_dist'], tuple(self.cv_proc.p_rect) )
 
     #------------------------------------------------
     
     def onStartStopAnalyzeVideo(self, event):
         '''Choose a video file and starts analysis'''
         if self.session_start_time == -1: # not in analysis session. start a session
-            dlg = wx.DirDialog(self, "Choose directory for analysis", getcwd(), wx.DD_DEFAULT_STYLE|wx.DD_DIR_MUST_EXIST)
+            dlg = wx.SingleChoiceDialog(self, 'Choose session input', 'Analyze video', ['Folder of JPEG frames', 'Video file'])
             if dlg.ShowModal() == wx.ID_CANCEL: return
-            self.fPath = dlg.GetPath()
-            self.sString = self.fPath[-8:]
-            self.frame_cnt = len(glob(path.join(self.fPath, '*.jpg')))
+            input_type = dlg.GetSelection()
+            dlg.Destroy()
+            if input_type == 0:
+                dlg = wx.DirDialog(self, "Choose directory for analysis", getcwd(), wx.DD_DEFAULT_STYLE|wx.DD_DIR_MUST_EXIST)
+            else:
+                wildcard = 'Video files|%s'%(';'.join([ '*'+ext for ext in video_exts ]))
+                dlg = wx.FileDialog(self, "Choose video file for analysis", getcwd(), wildcard=wildcard, style=wx.FD_OPEN|wx.FD_FILE_MUST_EXIST)
+            if dlg.ShowModal() == wx.ID_CANCEL: return
+            src_path = dlg.GetPath()
+            dlg.Destroy()
+            self.frame_src = open_frame_src(src_path) # takes a while for a new video file; its seek index is made
+            self.frame_cnt = self.frame_src.frame_cnt
             if self.frame_cnt == 0:
-                show_msg('No jpg frame images in the chosen directory.')
-                self.fPath = ''
+                if input_type == 0: show_msg('No jpg frame images in the chosen directory.')
+                else: show_msg('No frame could be read from the chosen video file.')
+                self.frame_src.release()
+                self.frame_src = None
+                self.frame_cnt = 0
                 return
-            fNames = self.fPath.split('/')
+            self.fPath = get_result_base(src_path) # result files are <fPath>.csv, <fPath>.npz, ..
+            self.sString = self.fPath[-8:]
+            if self.cv_proc.flag_lut == True: self.cv_proc.get_color_lut() # make the colour lookup table of this session now, not on the first frame
+            fNames = src_path.split('/')
             self.sTxt_fp.SetLabel( '%s / %s / %s / %s'%(fNames[-4],fNames[-3],fNames[-2],fNames[-1]) )
-            result_csv_file = self.fPath + '.csv'
-            if path.isfile(result_csv_file) == False: # result CSV file doesn't exist
-                for i in range(1, self.frame_cnt+1):
-                    self.oData[i] = dict( hPos = (None,None), tbPos = (None,None), h2ac_dist = None )
-                    # hPos: head tag position, 
-                    # tbPos: tail-base tag position, 
-                    # h2ac_dist: distance from the head tag to the arena center 
-            else: # result CSV file exists
-                f = open(result_csv_file, 'r')
-                lines = f.readlines()
-                f.close()
-                for i in range(1, self.frame_cnt+1):
-                    self.oData[i] = dict( hPos = (None,None), tbPos = (None,None), h2ac_dist = None )
-                    if i < len(lines):
-                        items = [ x.strip() for x in lines[i].split(',') ]
-                        idx_ = int(items[0])
-                        if items[1] == 'None': hPos_val = (None, None)
-                        elif items[1] == 'D': hPos_val = ('D', 'D')
-                        else: hPos_val = ( int(items[1]), int(items[2]) )
-                        if items[3] == 'None': tbPos_val = (None, None)
-                        elif items[3] == 'D': tbPos_val = ('D', 'D')
-                        else: tbPos_val = ( int(items[3]), int(items[4]) )
-                        if items[7] == 'None': h2ac_dist_val = None
-                        else: h2ac_dist_val = int(items[7])
-                        self.oData[idx_]['hPos'] = copy(hPos_val)
-                        self.oData[idx_]['tbPos'] = copy(tbPos_val)
-                        self.oData[idx_]['h2ac_dist'] = copy(h2ac_dist_val)
+            self.oData = load_result(self.fPath, self.frame_cnt, journal=True) # all the changes are recorded in the edit journal
+            if self.oData.p_rect != None: self.cv_proc.p_rect = list(self.oData.p_rect) # arena as it was adjusted last time
+            self.oData.p_rect = self.cv_proc.p_rect # same list; it's saved with the results, following adjustments (onAdjustRect)
+            self.last_autosave_time = time()
             self.fi = 1
             self.session_start_time = time()
             self.btn_start.SetLabel('Stop analysis')
             ### start video recorder
-            self.video_path = self.fPath + '.avi'
-            fp = path.join(self.fPath, 'f%06i.jpg'%self.fi)
-            img = load_img(fp, flag='cv')
+            self.video_path = get_video_out_path(src_path)
+            self.stage_timer.reset()
+            self.prefetcher = FramePrefetcher(self.frame_src, stage_timer=self.stage_timer)
+            img = self.prefetcher.load(self.fi)
             self.cv_proc.start_video_rec( self.video_path, img )
+            self.renderer.set_frame_size(self.cv_proc.fSize)
+            self.preview = PreviewStore(src_path, self.fPath, self.frame_cnt)
             self.proc_img() # process 1st image
         else: # in session. stop it.
+            self.pause_run() # run_th is joined first, so that frames tracked until now are in the saved data
+            self.is_running = False
+            self.sTxt_fps.SetLabel('')
             result = show_msg(msg='Save data?', cancel_btn = True)
             if result == True: self.onSave(None)
-            if self.is_running == True: self.onSpace(None)
             self.session_start_time = -1
             self.sTxt_s_time.SetLabel('0:00:00')
-            self.btn_start.SetLabel('Analyze video (folder)')
+            self.btn_start.SetLabel('Analyze video')
             self.sTxt_fp.SetLabel('')
             self.loaded_img.SetBitmap(wx.NullBitmap)
             self.fPath = ''
             self.sString = ''
             self.frame_cnt = 0
             self.fi = 0
+            self.wait_autosave()
+            self.oData.journal.close(discard=True) # everything is saved or the user chose not to save
+            self.write_timing_report()
             self.oData = {}
             self.cv_proc.stop_video_rec()
+            self.prefetcher.stop()
+            self.prefetcher = None
+            self.frame_src.release()
+            self.frame_src = None
+            self.frame_cache.clear()
+            if self.timer_settle != None: self.timer_settle.Stop()
+            self.timer_settle = None
+            self.preview.stop()
+            self.preview = None
     
     # --------------------------------------------------       
     
     def onSave(self, event):
-        WD = 0 # walking distance
-        HM = 0 # head movements without walking (~ looking around)
-        nfH = 0 # number of frames when only head tag is detected
-        nfT = 0 # number of frames when only tail tag is detected
-        nfB = 0 # number of frames when only both tags are detected
-        nfN = 0 # number of frames when only no tags were detected 
         fp_ = self.fPath + '.csv'
-        fh = open(fp_, 'w')
-        fh.write('frame-index, hPosX, hPosY, tbPosX, tbPosY, WD, HM, h2ac_dist\n')
-        hsf = self.vFPS/2 # half second frames
-        for fi in range(1, self.frame_cnt+1):
-            h_ = self.oData[fi]['hPos']
-            t_ = self.oData[fi]['tbPos']
-            if type(h_[0]) == int and type(t_[0]) == int: nfB += 1
-            elif type(h_[0]) == int and type(t_[0]) != int: nfH += 1
-            elif type(h_[0]) != int and type(t_[0]) == int: nfT += 1
-            elif type(h_[0]) != int and type(t_[0]) != int: nfN += 1 
-            wd_ = 0; hm_ = 0
-            if fi > (hsf) and fi % hsf == 0:
-                ### every half second, calculate walking-distance and head-movement
-                ph_ = self.oData[fi-hsf]['hPos']
-                pt_ = self.oData[fi-hsf]['tbPos']
-                if type(h_[0])==int and type(h_[1])==int and type(ph_[0])==int and type(ph_[1])==int: # all the head position info available
-                    hl = np.sqrt( (h_[0]-ph_[0])**2 + (h_[1]-ph_[1])**2 ) # line connecting two head tag positions
-                    if hl > (self.tagSz/2): # if movement distance is too small, discard
-                        if type(t_[0])==int and type(t_[1])==int and type(pt_[0])==int and type(pt_[1])==int: # all the tail position info available
-                            hla = np.degrees(np.arctan2( (h_[1]-ph_[1]), (h_[0]-ph_[0]) )) # degree of line connecting two head tag positions 
-                            tla = np.degrees(np.arctan2( (t_[1]-pt_[1]), (t_[0]-pt_[0]) )) # degree of line connecting two tail tag positions
-                            angle_diff = calc_angle_diff(hla, tla)
-                            if angle_diff < 45: # 45 degrees difference is considered as more or less similar direction to account it as 'walking'
-                                wd_ = hl # walking distance for one frame
-                                WD += hl # total walking distance
-                        if wd_ == 0:
-                            # if walking didn't happen, hl is recorded as head movement
-                            hm_ = hl
-                            HM += hl
-            line = '%i, %s, %s, %s, %s, %i, %i, %s\n'%(fi, str(h_[0]), str(h_[1]), str(t_[0]), str(t_[1]), wd_, hm_, str(self.oData[fi]['h2ac_dist'])) 
-            fh.write(line)
-        fh.write('------------------------------------------------------------------\n')
-        fh.write('Total walking distance, %i\n'%WD)
-        fh.write('Total head movements without walking, %i\n'%HM)
-        fh.write('------------------------------------------------------------------\n')
-        fh.write('Number of frames when both tags are detected, %i\n'%nfB)
-        fh.write('Number of frames when only head tag is detected, %i\n'%nfH)
-        fh.write('Number of frames when only tail tag is detected, %i\n'%nfT)
-        fh.write('Number of frames when no tags are detected, %i\n'%nfN)
-        fh.close()
+        self.wait_autosave()
+        save_result(self.fPath, self.oData, self.frame_cnt, self.vFPS, self.tagSz)
 
         msg = 'Saved.\n'
         chr_num = 50 # characters in one line
@@ -489,6 +648,48 @@ class AMAFrame(wx.Frame):
         if self.session_start_time != -1:
             e_time = time() - self.session_start_time
             self.sTxt_s_time.SetLabel( str(timedelta(seconds=e_time)).split('.')[0] )
+            ### compact the edit journal in background
+            if time()-self.last_autosave_time >= self.autosave_intv:
+                if self.oData.journal.n_edits > 0 and (self.autosave_th == None or self.autosave_th.isAlive() == False):
+                    self.autosave_th = Thread(target=compact_result, args=(self.oData,))
+                    self.autosave_th.start()
+                self.last_autosave_time = time()
+            if self.show_timing == True and time()-self.last_timing_time >= 1:
+                self.SetStatusText( self.stage_timer.summary() )
+                self.last_timing_time = time()
+
+    # --------------------------------------------------
+
+    def wait_autosave(self):
+        ''' wait until compacting the edit journal finishes
+        '''
+        if self.autosave_th != None:
+            self.autosave_th.join()
+            self.autosave_th = None
+
+    # --------------------------------------------------
+
+    def write_timing_report(self):
+        ''' write durations of frame pipeline stages in this session into <fPath>_timing.txt
+        '''
+        self.stage_timer.write_report(self.fPath + '_timing.txt', title='%s, %i frames'%(self.fPath, self.frame_cnt))
+
+    # --------------------------------------------------
+
+    def onToggleTiming(self, event):
+        self.show_timing = not self.show_timing
+        if self.show_timing == False: self.SetStatusText('')
+
+    # --------------------------------------------------
+
+    def onFillGaps(self, event):
+        ''' interpolate tag positions over short gaps of failed detections in the whole session
+        '''
+        if self.fPath == '': return
+        self.pause_run()
+        n_h, n_tb = self.cv_proc.fill_gaps(self.max_gap)
+        self.show_msg_in_statbar('Interpolated frames (gaps up to %i frames); head: %i, tail-base: %i'%(self.max_gap, n_h, n_tb))
+        self.proc_img() # the current frame might be filled
 
     # --------------------------------------------------
 
@@ -502,9 +703,16 @@ class AMAFrame(wx.Frame):
         self.timer.Stop()
         result = True
         if self.session_start_time != -1: # session is running
-            result = show_msg(msg='Session is not stopped..\nUnsaved data will be lost. (Stop analysis or Cmd+S to save.)\nOkay to proceed to exit?', cancel_btn = True)
+            result = show_msg(msg='Session is not stopped..\nUnsaved data will be restored from the autosave when this folder is opened next time. (Stop analysis or Cmd+S to save.)\nOkay to proceed to exit?', cancel_btn = True)
         if result == True:
+            if self.is_running == True: self.onSpace(None)
+            if self.session_start_time != -1: # keep the journal for the next time
+                self.wait_autosave()
+                self.oData.journal.close()
+                self.write_timing_report()
             if self.cv_proc.video_rec != None: self.cv_proc.stop_video_rec()
+            if self.prefetcher != None: self.prefetcher.stop()
+            if self.preview != None: self.preview.stop()
             wx.FutureCall(500, self.Destroy)
 
 # ======================================================
@@ -0,0 +1,249 @@
+'''
+Benchmark of the AMA frame pipeline on sample_data (f000001.jpg ~ f000100.jpg).
+No display is needed.
+
+Measures per-call latency and calls/sec of load_img, CVProc.find_color/find_class,
+CVProc.get_blob_center, CVProc.proc_img (whole tracking of a frame)
+and the result computation done on saving (calc_movements & write_result_csv).
+Frames can be looped (--loop) to simulate long sessions
+and tiled (--tile) to simulate larger frames.
+With --lut, the colour lookup table is made (CVProc.get_color_lut), 
+find_class is measured and frames are tracked with the table instead of HSV conversion.
+
+Results are compared with a stored baseline (benchmark_baseline.json);
+a measurement slower than the baseline by more than the tolerance is flagged.
+Tag positions of sample_data are compared with golden outputs
+(sample_data_golden.csv), so that optimisations can't silently change results.
+
+e.g.) python benchmark.py
+      python benchmark.py --loop 20 --tile 2
+      python benchmark.py --lut
+      python benchmark.py --update-baseline
+      python benchmark.py --update-golden
+'''
+
+import argparse, json, tempfile, shutil
+from os import path
+from sys import argv, exit
+from time import time
+from glob import glob
+
+import numpy as np
+
+from modules.base_funcs import load_cv_img, writeFile
+from modules.batch_proc import BatchProc
+from modules.session_data import SessionData, calc_movements, write_result_csv
+from modules.stage_timer import StageTimer
+
+CWD = path.dirname(path.abspath(__file__))
+SAMPLE_DIR = path.join(CWD, 'sample_data')
+BASELINE_FP = path.join(CWD, 'benchmark_baseline.json')
+GOLDEN_FP = path.join(CWD, 'sample_data_golden.csv')
+bench_items = ['load_img', 'color_lut', 'find_color(frame)', 'find_class(frame)', 'find_color(coarse)', 'find_color(tag)', 'find_class(tag)', 'get_blob_center', 'proc_img', 'save_metrics'] # in order of report
+
+# ======================================================
+
+class Benchmark:
+    ''' Runs the frame pipeline over sample frames and measures each part.
+    BatchProc stands in as the parent of CVProc as in headless tracking.
+    '''
+    def __init__(self, loop=1, tile=1, repeat=3, sString='287_Sh_1', lut=False):
+        self.loop = loop # how many times the sample frames are played in a row
+        self.tile = tile # frames are tiled 'tile' x 'tile' times
+        self.lut = lut # use the colour lookup table (about 1.5 seconds to make)
+        self.repeat = repeat # repeat of micro benchmarks (load_img, find_color, get_blob_center) over all the sample frames
+        self.fps = sorted(glob(path.join(SAMPLE_DIR, 'f*.jpg')))
+        self.bp = BatchProc(SAMPLE_DIR)
+        self.bp.sString = sString # determines the head tag color
+        self.timer = StageTimer(window=100000)
+
+    # --------------------------------------------------
+
+    def get_frame(self, img):
+        if self.tile > 1: img = np.tile(img, (self.tile, self.tile, 1))
+        return img
+
+    # --------------------------------------------------
+
+    def run(self):
+        ''' returns the stage timer with measurements
+        and tag positions of the first len(sample frames) frames
+        '''
+        frames = []
+        for r_ in xrange(self.repeat):
+            for fp in self.fps:
+                t0 = time()
+                img = load_cv_img(fp)
+                self.timer.add('load_img', t0)
+                if r_ == 0: frames.append( self.get_frame(img) )
+        cv_proc = self.bp.cv_proc
+        cv_proc.fSize = (frames[0].shape[1], frames[0].shape[0])
+        if self.lut == True:
+            t0 = time()
+            cv_proc.get_color_lut() # made once in a session
+            self.timer.add('color_lut', t0)
+            cv_proc.flag_lut = True # proc_img classifies tag colors with the table
+        self.bench_color(cv_proc, frames)
+        n_frames = len(frames) * self.loop
+        tPos = self.bench_tracking(cv_proc, frames, n_frames)
+        t0 = time()
+        calc_movements(self.bp.oData, n_frames, self.bp.vFPS, self.bp.tagSz)
+        tmp_dir = tempfile.mkdtemp()
+        write_result_csv(path.join(tmp_dir, 'bench.csv'), self.bp.oData, n_frames, self.bp.vFPS, self.bp.tagSz)
+        self.timer.add('save_metrics', t0)
+        shutil.rmtree(tmp_dir)
+        return self.timer, tPos
+
+    # --------------------------------------------------
+
+    def bench_color(self, cv_proc, frames):
+        ''' color detection (HSV and, with self.lut, lookup table) and blob center; full frame,
+        coarse to fine in full frame (as in reacquisition) and tag-sized area (as in tracking)
+        '''
+        HSVmin, HSVmax = cv_proc.get_HSV_range(0)
+        tagSz = self.bp.tagSz
+        frame_rect = (50, 0, cv_proc.fSize[0], cv_proc.fSize[1])
+        for r_ in xrange(self.repeat):
+            for img in frames:
+                t0 = time()
+                grey_img, offset = cv_proc.find_color(frame_rect, img, HSVmin, HSVmax)
+                t0 = self.timer.add('find_color(frame)', t0)
+                cv_proc.get_blob_center(grey_img, cv_proc.contour_threshold, offset)
+                t0 = self.timer.add('get_blob_center', t0)
+                cv_proc.find_color(frame_rect, img, HSVmin, HSVmax, 4) # reacquisition with reacq_step = 4
+                t0 = self.timer.add('find_color(coarse)', t0)
+                cp = (cv_proc.fSize[0]/2, cv_proc.fSize[1]/2)
+                rect_ = (int(cp[0]-tagSz*1.5), int(cp[1]-tagSz*1.5), int(cp[0]+tagSz*1.5), int(cp[1]+tagSz*1.5))
+                cv_proc.find_color(rect_, img, HSVmin, HSVmax)
+                t0 = self.timer.add('find_color(tag)', t0)
+                if self.lut == False: continue
+                cv_proc.find_class(frame_rect, img, 1)
+                t0 = self.timer.add('find_class(frame)', t0)
+                cv_proc.find_class(rect_, img, 1)
+                self.timer.add('find_class(tag)', t0)
+
+    # --------------------------------------------------
+
+    def bench_tracking(self, cv_proc, frames, n_frames):
+        ''' track 'n_frames' frames with CVProc.proc_img,
+        looping the sample frames
+        '''
+        bp = self.bp
+        bp.frame_cnt = n_frames
+        bp.oData = SessionData(n_frames)
+        tmp_dir = tempfile.mkdtemp()
+        cv_proc.start_video_rec(path.join(tmp_dir, 'bench.avi'), frames[0])
+        for fi in xrange(1, n_frames+1):
+            bp.fi = fi
+            img = frames[(fi-1) % len(frames)].copy()
+            t0 = time()
+            rIMG, rTP, h2ac_dist = cv_proc.proc_img(img)
+            bp.oData[fi]['hPos'] = rTP[0]
+            bp.oData[fi]['h2ac_dist'] = h2ac_dist
+            bp.oData[fi]['tbPos'] = rTP[1]
+            self.timer.add('proc_img', t0)
+        cv_proc.stop_video_rec()
+        shutil.rmtree(tmp_dir)
+        tPos = []
+        for fi in xrange(1, len(frames)+1):
+            tPos.append( [ bp.oData[fi]['hPos'], bp.oData[fi]['tbPos'], bp.oData[fi]['h2ac_dist'] ] )
+        return tPos
+
+# ======================================================
+
+def tPos_to_lines(tPos):
+    ''' returns lines of golden output from tag positions
+    '''
+    lines = []
+    for i in xrange(len(tPos)):
+        hPos, tbPos, dist = tPos[i]
+        lines.append( '%i, %s, %s, %s, %s, %s'%(i+1, str(hPos[0]), str(hPos[1]), str(tbPos[0]), str(tbPos[1]), str(dist)) )
+    return lines
+
+# --------------------------------------------------
+
+def chk_golden(tPos):
+    ''' returns list of mismatched lines with golden outputs (None if there's no golden file)
+    '''
+    if path.isfile(GOLDEN_FP) == False: return None
+    golden = [ l_.strip() for l_ in open(GOLDEN_FP, 'r').readlines() if l_.strip() != '' and l_[0] != '#' ]
+    lines = tPos_to_lines(tPos)
+    mismatch = []
+    for i in xrange(max(len(golden), len(lines))):
+        g_ = golden[i] if i < len(golden) else '(none)'
+        l_ = lines[i] if i < len(lines) else '(none)'
+        if g_ != l_: mismatch.append( 'golden: %s / result: %s'%(g_, l_) )
+    return mismatch
+
+# --------------------------------------------------
+
+def report(timer, baseline, tolerance):
+    ''' print measurements, comparing with the baseline.
+    returns measured mean (ms) of each item and names of regressed items
+    '''
+    means = {}
+    regressed = []
+    print '%-18s %8s %10s %9s %9s %9s %10s'%('item', 'calls', 'calls/s', 'mean(ms)', 'p50(ms)', 'p90(ms)', 'baseline')
+    for item in bench_items:
+        if item not in timer.count: continue
+        mean_ = timer.total[item] / timer.count[item] * 1000
+        means[item] = mean_
+        p50, p90 = timer.percentiles(item, [50, 90])
+        b_str = '-'
+        if item in baseline:
+            b_str = '%.3f'%(baseline[item])
+            if mean_ > baseline[item] * (1+tolerance):
+                b_str += ' SLOWER'
+                regressed.append(item)
+        print '%-18s %8i %10.1f %9.3f %9.3f %9.3f %10s'%(item, timer.count[item], 1000.0/max(mean_, 1e-6), mean_, p50, p90, b_str)
+    return means, regressed
+
+# --------------------------------------------------
+
+def main(args):
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('--loop', type=int, default=1, help='play the sample frames this number of times in a row for tracking')
+    parser.add_argument('--tile', type=int, default=1, help='tile frames N x N times to simulate larger frames')
+    parser.add_argument('--repeat', type=int, default=3, help='repeat of micro benchmarks over the sample frames')
+    parser.add_argument('--session', default='287_Sh_1', help='session string, which determines the head tag color')
+    parser.add_argument('--lut', action='store_true', help='measure find_class and track with the colour lookup table')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='flag a measurement slower than the baseline by more than this ratio')
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--update-golden', action='store_true', help='store tag positions of this run as golden outputs')
+    args = parser.parse_args(args)
+
+    bench = Benchmark(args.loop, args.tile, args.repeat, args.session, args.lut)
+    print 'Benchmark: %i sample frames, loop %i, tile %i%s'%(len(bench.fps), args.loop, args.tile, ['', ', lookup table'][args.lut])
+    timer, tPos = bench.run()
+    cond_key = 'loop%i_tile%i'%(args.loop, args.tile) # baseline is kept for each condition
+    if args.lut == True: cond_key += '_lut'
+    baseline = {}
+    if path.isfile(BASELINE_FP) == True: baseline = json.load(open(BASELINE_FP, 'r'))
+    means, regressed = report(timer, baseline.get(cond_key, {}), args.tolerance)
+    if args.update_baseline == True:
+        baseline[cond_key] = means
+        writeFile(BASELINE_FP, json.dumps(baseline, indent=2, sort_keys=True), mode='w')
+        print 'Baseline is updated.'
+
+    mismatch = []
+    if args.tile == 1: # golden outputs are for frames of the original size
+        if args.update_golden == True:
+            writeFile(GOLDEN_FP, '# frame index, head x, head y, tail-base x, tail-base y, head to arena center distance\n' + '\n'.join(tPos_to_lines(tPos)) + '\n', mode='w')
+            print 'Golden outputs are updated.'
+        else:
+            mismatch = chk_golden(tPos)
+            if mismatch == None:
+                print 'No golden outputs. (run with --update-golden)'
+                mismatch = []
+            elif len(mismatch) == 0: print 'Tag positions match golden outputs.'
+            else:
+                print 'Tag positions DIFFER from golden outputs in %i frames:'%(len(mismatch))
+                for m_ in mismatch[:10]: print '  ' + m_
+    if len(regressed) > 0: print 'Slower than baseline: %s'%(', '.join(regressed))
+    if len(regressed) > 0 or len(mismatch) > 0: return 1
+    return 0
+
+# ======================================================
+
+if __name__ == '__main__':
+    exit( main(argv[1:]) )
@@ -0,0 +1,63 @@
+import plistlib
+
+from modules.cv_proc import CVProc, tag_colors
+
+# ======================================================
+
+class Arena:
+    ''' One of several arenas filmed in the same frames.
+    This object stands in for the parent of the CVProc of the arena,
+    as BatchProc does for a single arena session,
+    carrying the arena's own tag positions (oData) and result files (<fPath>_<name>.csv, ..).
+    Frames are decoded once by BatchProc (or VideoExport) and given to each arena.
+    head: head tag color (see get_tag_color); if None, the color of the session (see get_HSV_range)
+    '''
+    def __init__(self, bp, name, rect, head=None, tail='green'):
+        self.name = name
+        self.fPath = '%s_%s'%(bp.fPath, name) # base path of result files of this arena
+        self.sString = bp.sString
+        self.blue_ht_sessions = bp.blue_ht_sessions
+        self.fi = 0 # current frame index; set by BatchProc
+        self.frame_cnt = 0
+        self.vFPS = bp.vFPS
+        self.tagSz = bp.tagSz
+        self.oData = {} # output data of this arena
+        self.stage_timer = bp.stage_timer # stages are recorded together with the other arenas
+        self.cv_proc = CVProc(self)
+        self.cv_proc.p_rect = [ int(v) for v in rect ]
+        if head == None: head_range = self.cv_proc.get_HSV_range(0) # blue in blue_ht_sessions, otherwise red
+        else: head_range = get_tag_color(head)
+        self.cv_proc.HSV_ranges = [ head_range, get_tag_color(tail) ]
+        self.cv_proc.flag_render = False # overlays are drawn after all the arenas of a frame are tracked
+        self.cv_proc.status_pos = ( self.cv_proc.p_rect[0], max(15, self.cv_proc.p_rect[1]-5) ) # above the arena
+
+# ======================================================
+
+def get_tag_color(color):
+    ''' returns HSV range of a tag color,
+    which is a name in tag_colors ('red', 'blue' or 'green')
+    or [[H,S,V (min)], [H,S,V (max)]]
+    '''
+    if isinstance(color, basestring): return tag_colors[color]
+    return ( tuple(color[0]), tuple(color[1]) )
+
+# --------------------------------------------------
+
+def load_arenas(plist_fp, bp):
+    ''' returns list of Arena from a plist file such as below.
+    'head' and 'tail' are optional (default: head tag color of the session, as in a single arena session, and green).
+    <dict><key>arenas</key><array>
+      <dict><key>name</key><string>A</string>
+        <key>rect</key><array><integer>15</integer><integer>70</integer><integer>470</integer><integer>476</integer></array>
+        <key>head</key><string>blue</string></dict>
+      ..
+    </array></dict>
+    bp: BatchProc (or an object with fPath, sString, vFPS, tagSz, ..) of the session
+    '''
+    cfg = plistlib.readPlist(plist_fp)
+    arenas = []
+    for a_ in cfg['arenas']:
+        arenas.append( Arena(bp, str(a_['name']), a_['rect'], a_.get('head'), a_.get('tail', 'green')) )
+    names = [ a_.name for a_ in arenas ]
+    if len(set(names)) != len(names): raise ValueError('Arena names are not unique in %s'%(plist_fp))
+    return arenas
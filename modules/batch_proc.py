@@ -0,0 +1,292 @@
+import argparse
+from os import path
+from sys import argv
+from time import time, sleep
+from glob import glob
+from multiprocessing import Pool, Manager, cpu_count
+
+import cv2
+import numpy as np
+
+from modules.cv_proc import CVProc, blue_ht_sessions
+from modules.arena import load_arenas
+from modules.session_data import load_result, save_result, compact_result, ST_HELD
+from modules.stage_timer import StageTimer
+from modules.frame_src import FramePrefetcher, open_frame_src, get_result_base, get_video_out_path, video_exts, CAP_FRAME_COUNT
+
+# ======================================================
+
+class BatchProc:
+    ''' Headless tracking of one session (folder of frame images or video file).
+    This object stands in for AMAFrame as the parent of CVProc,
+    carrying the attributes CVProc reads (fi, frame_cnt, oData, ..),
+    and runs CVProc.proc_img over every frame without any display.
+    With several arenas (see Arena), each frame is decoded once
+    and tracked by the CVProc of each arena.
+    '''
+    def __init__(self, fPath, vFPS=60, tagSz=10, arenas_fp=None):
+        self.src_path = fPath.rstrip('/') # folder path including frame images, or video file path
+        self.fPath = get_result_base(self.src_path) # base path of result files
+        self.sString = self.fPath[-8:] # session string such as '287_Sh_1', '289_NE_1', and so on..
+        self.blue_ht_sessions = blue_ht_sessions
+        self.fi = 0 # current frame index
+        self.frame_src = None
+        self.frame_cnt = 0
+        self.vFPS = vFPS # fps for video file
+        self.tagSz = tagSz # head/tail_base tag size
+        self.oData = {} # output data
+        self.autosave_intv = 20000 # compact the edit journal when it has this number of edits
+        self.stage_timer = StageTimer() # durations of frame pipeline stages
+        self.cv_proc = CVProc(self)
+        self.arenas = [] # Arena objects, when several arenas are tracked in the frames
+        if arenas_fp != None: self.arenas = load_arenas(arenas_fp, self)
+
+    # --------------------------------------------------
+
+    def get_targets(self):
+        ''' returns arenas, or this object itself for a single arena session;
+        each has its own cv_proc, oData and fPath
+        '''
+        if len(self.arenas) > 0: return self.arenas
+        return [self]
+
+    # --------------------------------------------------
+
+    def run(self, progress_intv=1000, progress_q=None, stack_n=0, max_gap=0, render=True):
+        ''' track all the frames and write <fPath>.csv, <fPath>.avi and <fPath>_timing.txt
+        (<fPath>_<arena name>.csv for each arena, when there are arenas)
+        progress_intv: report progress every this number of frames (0: no reporting)
+        progress_q: if given, progress is put into this queue 
+          as (session string, number of newly processed frames) instead of printing
+        stack_n: if larger than 0, frames are tracked in stacks of this number of frames
+          with CVProc.track_batch. (no annotated video is written in this case)
+        max_gap: if larger than 0, tag positions are interpolated over gaps of failed detections
+          up to this number of frames after tracking (CVProc.fill_gaps)
+        render: draw the overlay and write the annotated video while tracking.
+          if it's False, the video can be made later from the results (see VideoExport)
+        '''
+        self.frame_src = open_frame_src(self.src_path)
+        self.frame_cnt = self.frame_src.frame_cnt
+        if self.frame_cnt == 0:
+            print 'No frame images in %s'%(self.src_path)
+            self.frame_src.release()
+            return False
+        for t_ in self.get_targets():
+            t_.frame_cnt = self.frame_cnt
+            t_.oData = load_result(t_.fPath, self.frame_cnt, journal=True) # a crashed run resumes from its journal
+            t_.oData.p_rect = t_.cv_proc.p_rect # saved with the results, for drawing the arena later (VideoExport)
+        self.progress_intv = progress_intv
+        self.progress_q = progress_q
+        self.reported_fi = 0 # frame index, up to which the progress was reported
+        self.start_time = time()
+        self.stage_timer.reset()
+        prefetcher = FramePrefetcher(self.frame_src, stage_timer=self.stage_timer)
+        if stack_n > 0: self.track_stacks(prefetcher, stack_n)
+        else: self.track_frames(prefetcher, render)
+        prefetcher.stop()
+        self.frame_src.release()
+        for t_ in self.get_targets():
+            if max_gap > 0: t_.cv_proc.fill_gaps(max_gap)
+            save_result(t_.fPath, t_.oData, self.frame_cnt, self.vFPS, self.tagSz)
+            t_.oData.journal.close(discard=True)
+        self.stage_timer.write_report(self.fPath + '_timing.txt', title='%s, %i frames'%(self.src_path, self.frame_cnt))
+        if progress_q != None: progress_q.put( (self.sString, self.frame_cnt-self.reported_fi) )
+        else: print '%s: done. %i frames in %.1f seconds'%(self.sString, self.frame_cnt, time()-self.start_time)
+        return True
+
+    # --------------------------------------------------
+
+    def track_frames(self, prefetcher, render=True):
+        ''' track frame by frame with CVProc.proc_img, recording the annotated video
+        (no drawing and recording when 'render' is False)
+        '''
+        self.fi = 1
+        img = prefetcher.get(self.fi)
+        self.cv_proc.flag_render = render
+        if render == True: self.cv_proc.start_video_rec(get_video_out_path(self.src_path), img)
+        for fi in xrange(1, self.frame_cnt+1):
+            self.fi = fi
+            if fi > 1: img = prefetcher.get(fi)
+            if len(self.arenas) > 0: self.track_arenas(img, render)
+            else:
+                rIMG, rTP, h2ac_dist = self.cv_proc.proc_img(img)
+                self.oData.set(fi, 'hPos', rTP[0], self.cv_proc.tag_st[0])
+                self.oData[fi]['h2ac_dist'] = h2ac_dist
+                self.oData.set(fi, 'tbPos', rTP[1], self.cv_proc.tag_st[1])
+            self.report_progress(fi)
+        if render == True: self.cv_proc.stop_video_rec()
+
+    # --------------------------------------------------
+
+    def track_arenas(self, img, render=True):
+        ''' track all the arenas in a frame ('img') of self.fi.
+        overlays are drawn after all the arenas are tracked,
+        so that a drawing doesn't hide tags of another arena.
+        '''
+        results = []
+        for a_ in self.arenas:
+            a_.fi = self.fi
+            rIMG, rTP, h2ac_dist = a_.cv_proc.proc_img(img)
+            a_.oData.set(self.fi, 'hPos', rTP[0], a_.cv_proc.tag_st[0])
+            a_.oData[self.fi]['h2ac_dist'] = h2ac_dist
+            a_.oData.set(self.fi, 'tbPos', rTP[1], a_.cv_proc.tag_st[1])
+            results.append( (rTP, h2ac_dist, ST_HELD in a_.cv_proc.tag_st) )
+        if render == False: return
+        t0 = time()
+        for i, a_ in enumerate(self.arenas):
+            rTP, h2ac_dist, failed = results[i]
+            a_.cv_proc.draw_overlay(img, self.fi, rTP, h2ac_dist, failed)
+        self.stage_timer.add('overlay', t0)
+        self.cv_proc.video_rec.write(img) # one video of all the arenas
+
+    # --------------------------------------------------
+
+    def track_stacks(self, prefetcher, stack_n):
+        ''' track stacks of 'stack_n' frames with CVProc.track_batch
+        '''
+        img = prefetcher.get(1)
+        frames = np.empty( (stack_n,)+img.shape, dtype=np.uint8 )
+        for fi in xrange(1, self.frame_cnt+1, stack_n):
+            n_ = min(stack_n, self.frame_cnt-fi+1)
+            for k in xrange(n_):
+                if fi+k > 1: img = prefetcher.get(fi+k)
+                frames[k] = img
+            self.fi = fi+n_-1
+            if len(self.arenas) > 0:
+                t0 = time()
+                HSV_stack = None
+                if self.arenas[0].cv_proc.flag_lut == False: # HSV conversion of the stack is shared by arenas
+                    HSV_stack = cv2.cvtColor(frames[:n_].reshape(-1, frames.shape[2], 3), cv2.COLOR_BGR2HSV)
+                    self.stage_timer.add('hsv', t0)
+                for a_ in self.arenas:
+                    a_.fi = self.fi
+                    a_.cv_proc.track_batch(frames[:n_], fi, HSV_stack)
+            else: self.cv_proc.track_batch(frames[:n_], fi)
+            self.report_progress(self.fi)
+
+    # --------------------------------------------------
+
+    def report_progress(self, fi):
+        for t_ in self.get_targets():
+            if t_.oData.journal.n_edits >= self.autosave_intv: compact_result(t_.oData) # keep the journal short
+        if self.progress_intv <= 0 or fi-self.reported_fi < self.progress_intv: return
+        if self.progress_q != None: self.progress_q.put( (self.sString, fi-self.reported_fi) )
+        else: print '%s: %i/ %i frames, FPS: %.1f'%(self.sString, fi, self.frame_cnt, fi/(time()-self.start_time))
+        self.reported_fi = fi
+
+# ======================================================
+
+def init_worker():
+    cv2.setNumThreads(1) # parallelism comes from the worker processes
+
+# --------------------------------------------------
+
+def run_session(fPath, progress_q=None, stack_n=0, max_gap=0, render=True, arenas_fp=None):
+    try:
+        return BatchProc(fPath, arenas_fp=arenas_fp).run(progress_q=progress_q, stack_n=stack_n, max_gap=max_gap, render=render)
+    except Exception, e: # one broken session should not stop the others
+        print '%s: failed (%s)'%(fPath, str(e))
+        return False
+
+# --------------------------------------------------
+
+def get_session_folders(patterns):
+    ''' returns sessions (folders or video files) from paths and/or glob patterns
+    such as '/data/*_Sh_*'.
+    annotated videos made by this program (<base>.avi or <base>_ama.avi of another session)
+    are not sessions, and a session sharing the base of result files with
+    an earlier one (e.g. X.mp4 and X.mov) is skipped.
+    '''
+    candidates = []
+    for p_ in patterns:
+        for fp in sorted(glob(p_.rstrip('/'))):
+            if fp in candidates: continue
+            if path.isdir(fp) or path.splitext(fp)[1].lower() in video_exts: candidates.append(fp)
+    outputs = [ get_video_out_path(fp) for fp in candidates ]
+    folders = []
+    bases = []
+    for i, fp in enumerate(candidates):
+        if fp in outputs[:i]+outputs[i+1:]: continue # output video of another session
+        base = get_result_base(fp)
+        if base in bases:
+            print '%s: skipped; results of %s are written in the same names'%(fp, folders[bases.index(base)])
+            continue
+        folders.append(fp)
+        bases.append(base)
+    return folders
+
+# --------------------------------------------------
+
+def count_frames(fp):
+    ''' returns (an estimate of) the number of frames of a session 
+    without decoding it
+    '''
+    if path.isdir(fp): return len(glob(path.join(fp, '*.jpg')))
+    if path.isfile(fp + '.idx.npz'): # seek index is already made
+        try: return len(np.load(fp + '.idx.npz')['ts'])
+        except Exception: pass
+    cap = cv2.VideoCapture(fp)
+    n_ = cap.get(CAP_FRAME_COUNT) # container's frame count; it can be slightly off
+    cap.release()
+    return max(0, int(n_))
+
+# --------------------------------------------------
+
+def run_pool(folders, n_workers, stack_n=0, max_gap=0, render=True, arenas_fp=None, print_intv=5):
+    ''' fan session folders out over a pool of worker processes,
+    printing aggregate progress and frames/sec every 'print_intv' seconds.
+    '''
+    total_frames = sum([ count_frames(fp) for fp in folders ])
+    q = Manager().Queue()
+    pool = Pool(n_workers, initializer=init_worker)
+    results = [ pool.apply_async(run_session, (fp, q, stack_n, max_gap, render, arenas_fp)) for fp in folders ]
+    pool.close()
+    start_time = time()
+    last_print_time = start_time
+    frames_done = 0
+    while True:
+        while not q.empty():
+            sString, n_frames = q.get()
+            frames_done += n_frames
+        n_done = len([ r_ for r_ in results if r_.ready() ])
+        if time()-last_print_time >= print_intv or n_done == len(results):
+            e_time = time()-start_time
+            print '[%i/ %i sessions] %i/ %i frames, FPS: %.1f'%(n_done, len(results), frames_done, total_frames, frames_done/max(e_time, 1e-6))
+            last_print_time = time()
+        if n_done == len(results): break
+        sleep(0.5)
+    pool.join()
+    failed = [ folders[i] for i in range(len(folders)) if results[i].get() != True ]
+    if len(failed) > 0: print 'Failed sessions: %s'%(', '.join(failed))
+
+# ======================================================
+
+def run_batch(args):
+    ''' run BatchProc for each folder (or video file) given as an argument
+    e.g.) python ama.py --batch /data/287_Sh_1 /data/289_NE_1.mp4
+          python ama.py --batch -j 32 '/data/*_Sh_*'
+    '''
+    parser = argparse.ArgumentParser(prog='ama.py --batch')
+    parser.add_argument('folders', nargs='+', help='session folders, video files or glob patterns')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='number of worker processes (0: number of CPU cores)')
+    parser.add_argument('--stack', type=int, default=0, help='track stacks of this number of frames at once (no annotated video)')
+    parser.add_argument('--no-render', action='store_true', help='track without drawing and writing the annotated video (make it later with --export)')
+    parser.add_argument('--arenas', default=None, help='plist file of several arenas in the frames (see load_arenas); results are written per arena')
+    parser.add_argument('--fill-gaps', type=int, default=0, help='interpolate tag positions over gaps of failed detections (tag not found) up to this number of frames')
+    args = parser.parse_args(args)
+    folders = get_session_folders(args.folders)
+    if len(folders) == 0:
+        print 'No session folder found.'
+        return
+    n_workers = args.workers
+    if n_workers <= 0: n_workers = cpu_count()
+    n_workers = min(n_workers, len(folders))
+    if n_workers == 1:
+        for fPath in folders: BatchProc(fPath, arenas_fp=args.arenas).run(stack_n=args.stack, max_gap=args.fill_gaps, render=not args.no_render)
+    else:
+        run_pool(folders, n_workers, args.stack, args.fill_gaps, not args.no_render, args.arenas)
+
+# ======================================================
+
+if __name__ == '__main__':
+    run_batch(argv[1:])
@@ -1,4 +1,5 @@
 import Queue
+from threading import Thread
 from time import time, sleep
 from copy import copy
 from os import path
@@ -7,10 +8,14 @@ from glob import glob
 import cv2
 import numpy as np
 
-from modules.misc_funcs import get_time_stamp, writeFile, chk_msg_q, calc_pt_line_dist
+from modules.base_funcs import get_time_stamp, writeFile, chk_msg_q, calc_pt_line_dist, fourcc_func
+from modules.session_data import ST_OK, ST_INTERP, ST_MANUAL, ST_DELETED, ST_NONE, ST_HELD
 
 flag_window = True # create an opencv window or not
 flag_video_rec = False # video recording
+color_luts = {} # colour class lookup tables; key: HSV ranges of head and tail-base tags
+tag_colors = dict( red = ((175,100,90), (180,255,255)), blue = ((110,50,50), (120,255,255)), green = ((50,75,75), (70,255,255)) ) # HSV ranges of tag colors
+blue_ht_sessions = ['286_Sh_2', '287_NE_2', '288_Sh_2', '289_Sh_2', '290_Sh_2', '291_Sh_1', '292_Sh_1', '293_Sh_1', '294_Sh_1', '295_NE_1', '296_NE_1', '297_Sh_1', '298_Sh_2', '299_Sh_1', '300_NE_1', '301_NE_1', '302_NE_2', '303_NE_2', '304_NE_2', '305_NE_2', '306_Sh_0', '306_Sh_1', '307_Sh_1'] # head tag color is blue in these sessions (red in others)
 
 # ======================================================
 
@@ -19,10 +24,18 @@ class CVProc:
         self.parent = parent
 
         self.contour_threshold = 1
-        self.fourcc = cv2.cv.CV_FOURCC('x', 'v', 'i', 'd')
+        self.fourcc = fourcc_func('x', 'v', 'i', 'd')
         self.video_rec = None # video recorder
         self.fSize = (960, 540) # default frame size
         self.p_rect = [215, 70, 788, 476] # rect(x1,y1,x2,y2) for defining the bottom panel of the experimental box
+        self.lut = None # colour class lookup table of the current session
+        self.lut_sString = None # session string, for which 'lut' was made
+        self.flag_lut = False # classify tag colors with a lookup table (see get_color_lut) instead of HSV conversion; works on little endian machines only
+        self.reacq_step = 1 # when a tag is searched in the whole arena, every this number of pixels is checked first (1: full resolution); blobs smaller than it can be missed
+        self.flag_render = True # draw the overlay on tracked frames; off in tracking without the annotated video (see VideoExport)
+        self.HSV_ranges = None # HSV ranges of head and tail-base tag colors; if None, they're determined by the session string (see get_HSV_range)
+        self.status_pos = (10,25) # position of the status string in the overlay
+        self.tag_st = [None, None] # status codes of head and tail-base tag positions of the last proc_img
         self.video_rec = None
         
 
@@ -31,124 +44,446 @@ class CVProc:
     def start_video_rec(self, video_fp, frame_arr):
         self.fSize= (frame_arr.shape[1], frame_arr.shape[0])
         self.video_fSize = (int(self.fSize[0]/2), int(self.fSize[1]/2)) # output video frame size
-        self.video_rec = cv2.VideoWriter( video_fp, self.fourcc, self.parent.vFPS, self.video_fSize, 1 )
+        self.video_rec = VideoWriterThread( video_fp, self.fourcc, self.parent.vFPS, self.video_fSize, stage_timer=self.parent.stage_timer )
 
     # --------------------------------------------------
 
     def stop_video_rec(self):
-        self.video_rec.release()
+        self.video_rec.release() # writes all the queued frames before closing
         self.video_rec = None
 
     # --------------------------------------------------
     
     def proc_img(self, frame_arr):
+        ''' track head and tail-base tags in a frame ('frame_arr') of parent.fi.
+        a tag, of which the position is already determined, is not tracked again.
+        status codes of the found positions are kept in self.tag_st 
+        (ST_HELD, when a tag was not found and its previous position was kept),
+        to be given to oData.set with the positions.
+        the overlay is drawn on 'frame_arr' (when flag_render is on) 
+        and the frame is recorded (when video_rec is running).
+        returns the frame, tag positions (head & tail-base) and head to arena center distance
+        '''
         result_tPos = [] # 0:head tag position, 1:tail-base tag position
         failed_to_find_tag = False
-        tagSz = self.parent.tagSz
-        status_msg = "%i/ %i, "%(self.parent.fi, self.parent.frame_cnt)
-        #d_=None
-        for i in range(2): # head and tail
-            if i == 0:
-                tp = self.parent.oData[self.parent.fi]["hPos"] # coordinate for the tag of the current frame
-                t_col = (0,150,255) # rectangle color for head tag
-                if tp[0] != None and tp[1] != None: # coordinate is already determined 
-                    if tp != ('D', 'D'): # user intentionally deleted the info
-                        cv2.rectangle(frame_arr, (tp[0]-tagSz/2,tp[1]-tagSz/2), (tp[0]+tagSz/2,tp[1]+tagSz/2), t_col, -1)
-                    status_msg += 'H %s '%(str(tp))
-                    result_tPos.append(tp)
-                    continue
-                tag_key = 'hPos'
-                status_msg += 'H '
-            elif i == 1: 
-                tp = self.parent.oData[self.parent.fi]["tbPos"]
-                t_col = (255,255,255) # rectangle color for tail-base tag
-                if tp[0] != None and tp[1] != None: # coordinate is already determined 
-                    if tp != ('D', 'D'): # user intentionally deleted the info
-                        cv2.rectangle(frame_arr, (tp[0]-tagSz/2,tp[1]-tagSz/2), (tp[0]+tagSz/2,tp[1]+tagSz/2), t_col, -1)
-                    status_msg += 'T %s '%(str(tp))
-                    result_tPos.append(tp)
-                    continue
-                tag_key = 'tbPos'
-                status_msg += 'T '
-
-            if self.parent.fi > 1: pTagPos = self.parent.oData[self.parent.fi-1][tag_key] # tag position of the previous frame 
-            else: pTagPos = (None, None)
-            if type(pTagPos[0]) != int and type(pTagPos[1]) != int: # position info of tag is NOT available
-                rect_ = (50,0,self.fSize[0],self.fSize[1]) # there's reflected  blue color spot in upper left corner when the pink wallpaper was used
-            else:
-                rect_ = ( int(pTagPos[0]-tagSz*1.5), int(pTagPos[1]-tagSz*1.5), int(pTagPos[0]+tagSz*1.5), int(pTagPos[1]+tagSz*1.5) ) # x1,y1,x2,y2
-            
-            if i == 0:
-                if self.parent.sString in self.parent.blue_ht_sessions:
-                    HSVmin = (110,50,50); HSVmax = (120,255,255) # head tag color (blue)
-                else:
-                    HSVmin = (175,100,90); HSVmax = (180,255,255) # head tag color (others are red)
-            elif i == 1:
-                HSVmin = (50,75,75); HSVmax = (70,255,255) # tail tag color
-            
-            tmp_grey_img = self.find_color(rect_, frame_arr, HSVmin, HSVmax) ### color detection for tag
-            ''' 
-            if i == 0:
-                d_ = cv2.cvtColor(tmp_grey_img.copy(), cv2.cv.CV_GRAY2BGR)
-                d_ = cv2.add(frame_arr, d_)
-                cv2.rectangle(d_, (rect_[0],rect_[1]), (rect_[2],rect_[3]), (255,0,0), 2)
-            '''
-            wrect, rects = self.chk_contours(tmp_grey_img, self.contour_threshold)
-            if len(rects) == 0: cp = (-1, -1)
+        self.tag_st = [None, None]
+        area_memo = {} # converted (or classified) areas of this frame; shared by head and tail-base tag
+        for i, tag_key in enumerate(['hPos', 'tbPos']): # head and tail
+            tp = self.parent.oData[self.parent.fi][tag_key] # coordinate for the tag of the current frame
+            if tp[0] != None and tp[1] != None: # coordinate is already determined (or intentionally deleted by the user)
+                result_tPos.append(tp)
+                continue
+            pTagPos, ppTagPos = self.get_prev_pos(self.parent.fi, tag_key)
+            if self.flag_lut == True:
+                color_func = lambda rect_, step: self.find_class(rect_, frame_arr, 1<<i, step, area_memo) ### color detection for tag
             else:
-                ### get median center point of detected contour rects
-                cp_x = []; cp_y = []
-                for r_ in rects:
-                    cp_x.append( r_[0]+r_[2]/2 )
-                    cp_y.append( r_[1]+r_[3]/2 )
-                cp = ( int(np.median(cp_x)), int(np.median(cp_y)) )
-            if cp == (-1,-1): # if the tag is not detected,
-                cp = copy(pTagPos) # copy the previous tag position
+                HSVmin, HSVmax = self.get_HSV_range(i)
+                color_func = lambda rect_, step: self.find_color(rect_, frame_arr, HSVmin, HSVmax, step, area_memo) ### color detection for tag
+            cp, failed = self.locate_tag(color_func, pTagPos, ppTagPos)
+            if failed == True:
                 failed_to_find_tag = True
-            if type(pTagPos[0]) == int and type(pTagPos[1]) == int: # prev tag position is available
-                dist = np.sqrt( (cp[0]-pTagPos[0])**2 + (cp[1]-pTagPos[1])**2 ) # distance between tag positions of this frame and prev frame
-                if dist > tagSz*3: cp = (-1,-1) # if tag moved too much in one frame, ignore this result 
-            if type(cp[0]) == int and type(cp[1]) == int:
-                cv2.rectangle(frame_arr, (cp[0]-tagSz/2,cp[1]-tagSz/2), (cp[0]+tagSz/2,cp[1]+tagSz/2), t_col, -1) # draw tag
-            status_msg += '(%s,%s) '%(str(cp[0]), str(cp[1]))
+                self.tag_st[i] = ST_HELD
             result_tPos.append(cp)
+        h2acp_dist = self.calc_h2ac_dist(result_tPos[0])[1]
+        if self.flag_render == True:
+            t0 = time()
+            self.draw_overlay(frame_arr, self.parent.fi, result_tPos, h2acp_dist, failed_to_find_tag)
+            self.parent.stage_timer.add('overlay', t0)
+        if self.video_rec != None: self.video_rec.write(frame_arr) # resized and encoded in the writer thread
+        return frame_arr, result_tPos, h2acp_dist
+
+    # --------------------------------------------------
+
+    def draw_overlay(self, frame_arr, fi, tPos, h2ac_dist, failed=False):
+        ''' draw tag positions ('tPos'; head & tail-base), the arena, 
+        head to arena center distance and the status string of a frame ('fi') on 'frame_arr'.
+        used in tracking (proc_img) and in rebuilding the video from saved results (VideoExport).
+        failed: a tag was not found; the arena is drawn in red
+        '''
+        tagSz = self.parent.tagSz
+        status_msg = "%i/ %i, "%(fi, self.parent.frame_cnt)
+        for i, tag_key in enumerate(['hPos', 'tbPos']):
+            tp = tPos[i]
+            t_col = [(0,150,255), (255,255,255)][i] # rectangle color for head tag and tail-base tag
+            if type(tp[0]) == int and type(tp[1]) == int and tp != (-1,-1):
+                th_ = -1
+                if self.parent.oData.status[tag_key][fi] == ST_INTERP: th_ = 1 # interpolated position is drawn as outline
+                cv2.rectangle(frame_arr, (tp[0]-tagSz/2,tp[1]-tagSz/2), (tp[0]+tagSz/2,tp[1]+tagSz/2), t_col, th_) # draw tag
+            status_msg += '%s %s '%(['H', 'T'][i], str(tp))
 
         ### draw rectangle around the arena either white or red (red when there's a tag position info is missing.)
-        if failed_to_find_tag == True: col_ = (0,0,255)
+        if failed == True: col_ = (0,0,255)
         else: col_ = (255,255,255)
         cv2.rectangle(frame_arr, (self.p_rect[0],self.p_rect[1]), (self.p_rect[2],self.p_rect[3]), col_, 2)
 
-        ### draw line to center and calculate the distance to center from head tag
-        hcp_ = result_tPos[0] # head center point
-        if hcp_ == (None,None) or hcp_ == ('D','D'): h2acp_dist = None
+        ### draw line to center and the distance to center from head tag
+        if h2ac_dist != None:
+            acp_ = self.calc_h2ac_dist(tPos[0])[0] # arena center point
+            cv2.line(frame_arr, tPos[0], acp_, (0,0,0), 1)
+            cv2.putText(frame_arr, str(h2ac_dist), (acp_[0],acp_[1]+10), cv2.FONT_HERSHEY_PLAIN, fontScale=1.0, color=(0,0,0), thickness=1) # write distance
+
+        cv2.putText(frame_arr, status_msg, self.status_pos, cv2.FONT_HERSHEY_PLAIN, fontScale=1.5, color=(0,250,0), thickness=2) # write status
+
+    # --------------------------------------------------
+
+    def get_HSV_range(self, tag_idx):
+        ''' returns HSV range of the head (tag_idx 0) or tail-base (tag_idx 1) tag color
+        '''
+        if self.HSV_ranges != None: return self.HSV_ranges[tag_idx] # set for an arena (see Arena)
+        if tag_idx == 0:
+            if self.parent.sString in self.parent.blue_ht_sessions:
+                HSVmin, HSVmax = tag_colors['blue'] # head tag color (blue)
+            else:
+                HSVmin, HSVmax = tag_colors['red'] # head tag color (others are red)
+        elif tag_idx == 1:
+            HSVmin, HSVmax = tag_colors['green'] # tail tag color
+        return HSVmin, HSVmax
+
+    # --------------------------------------------------
+
+    def locate_tag(self, color_func, pTagPos, ppTagPos=(None,None)):
+        ''' find a tag around its predicted position from the previous positions
+        ('pTagPos': previous frame, 'ppTagPos': the frame before that),
+        or in the arena when the previous position is not available (or failed; (-1,-1)).
+        The search window starts from 1.5 x tagSz (plus half of the tag speed)
+        around the prediction and expands up to the gating distance / sqrt(2),
+        so that anything found in the window (even in its corner) is within the gating distance.
+        color_func: function taking a search rect (x1,y1,x2,y2) and a coarse search step, and 
+          returning the greyscale color detection result and its offset, such as find_color
+        returns the tag position and whether it failed to find the tag
+        '''
+        tagSz = self.parent.tagSz
+        failed = False
+        has_prev = self.is_pos(pTagPos)
+        if has_prev == False: # position info of tag is NOT available
+            rect_ = ( max(50,self.p_rect[0]), self.p_rect[1], self.p_rect[2], self.p_rect[3] ) # search in the arena; there's reflected  blue color spot in upper left corner when the pink wallpaper was used
+            cp = self.detect_tag(color_func, rect_, self.reacq_step)
         else:
-            r_ = self.p_rect
-            acp_ = (r_[0]+(r_[2]-r_[0])/2,r_[1]+(r_[3]-r_[1])/2) # arena center point
-            cv2.line(frame_arr, hcp_, acp_, (0,0,0), 1)
-            h2acp_dist = int(round( np.sqrt((acp_[0]-hcp_[0])**2 + (acp_[1]-hcp_[1])**2) ))
-            cv2.putText(frame_arr, str(h2acp_dist), (acp_[0],acp_[1]+10), cv2.FONT_HERSHEY_PLAIN, fontScale=1.0, color=(0,0,0), thickness=1) # write distance
-
-        cv2.putText(frame_arr, status_msg, (10,25), cv2.FONT_HERSHEY_PLAIN, fontScale=1.5, color=(0,250,0), thickness=2) # write status
-        self.video_rec.write( cv2.resize(frame_arr,self.video_fSize) )
-        #if d_ == None: 
-        return frame_arr, result_tPos, h2acp_dist
-        #else:
-        #    return d_, result_tPos, h2acp_dist
+            pred, speed = self.predict_pos(pTagPos, ppTagPos)
+            gate_r = tagSz*3 + speed # max. distance of the tag from the predicted position
+            max_r = gate_r / np.sqrt(2) # max. half size of search window; its corners are on the gating distance
+            r_ = min(tagSz*1.5 + speed/2, max_r) # half size of search window
+            while True:
+                rect_ = ( int(pred[0]-r_), int(pred[1]-r_), int(pred[0]+r_), int(pred[1]+r_) ) # x1,y1,x2,y2
+                cp = self.detect_tag(color_func, rect_)
+                if cp != (-1,-1) or r_ >= max_r: break
+                r_ = min(r_*2, max_r) # expand the search window
+        if cp == (-1,-1): # if the tag is not detected,
+            cp = copy(pTagPos) # copy the previous tag position
+            failed = True
+        return cp, failed
+
+    # --------------------------------------------------
+
+    def detect_tag(self, color_func, rect_, step=1):
+        ''' returns the median center point of color blobs in 'rect_' 
+        or (-1,-1) when there's none
+        '''
+        t0 = time()
+        tmp_grey_img, offset = color_func(rect_, step)
+        t0 = self.parent.stage_timer.add('hsv', t0)
+        cp = self.get_blob_center(tmp_grey_img, self.contour_threshold, offset)
+        self.parent.stage_timer.add('contours', t0)
+        return cp
+
+    # --------------------------------------------------
+
+    def predict_pos(self, pTagPos, ppTagPos):
+        ''' returns predicted tag position of the current frame
+        with constant velocity from the previous two positions,
+        and the speed (pixels/frame)
+        '''
+        if self.is_pos(ppTagPos) == False: return pTagPos, 0.0 # no velocity info
+        vx = pTagPos[0]-ppTagPos[0]; vy = pTagPos[1]-ppTagPos[1]
+        speed = np.sqrt(vx**2 + vy**2)
+        if speed > self.parent.tagSz*3: return pTagPos, 0.0 # not a movement (e.g. the tag was corrected by user)
+        return (pTagPos[0]+vx, pTagPos[1]+vy), speed
+
+    # --------------------------------------------------
+
+    def is_pos(self, tp):
+        ''' returns whether 'tp' is a tag position;
+        not (None, None), ('D', 'D') or a failed detection (-1, -1)
+        '''
+        return type(tp[0]) == int and type(tp[1]) == int and tuple(tp) != (-1,-1)
+
+    # --------------------------------------------------
+
+    def get_prev_pos(self, fi, tag_key):
+        ''' returns tag positions of the previous frame and the frame before that
+        '''
+        oData = self.parent.oData
+        pTagPos = (None, None); ppTagPos = (None, None)
+        if fi > 1: pTagPos = oData[fi-1][tag_key]
+        if fi > 2: ppTagPos = oData[fi-2][tag_key]
+        return pTagPos, ppTagPos
+
+    # --------------------------------------------------
+
+    def calc_h2ac_dist(self, hcp_):
+        ''' returns the arena center point and 
+        the distance from the head tag ('hcp_') to it
+        '''
+        r_ = self.p_rect
+        acp_ = (r_[0]+(r_[2]-r_[0])/2,r_[1]+(r_[3]-r_[1])/2) # arena center point
+        if hcp_ == (None,None) or hcp_ == ('D','D'): return acp_, None
+        return acp_, int(round( np.sqrt((acp_[0]-hcp_[0])**2 + (acp_[1]-hcp_[1])**2) ))
+
+    # --------------------------------------------------
+
+    def fill_gaps(self, max_gap):
+        ''' interpolate tag positions over short gaps of failed detections
+        (tag was not found) in the whole session (see SessionData.fill_gaps)
+        and update head to arena center distance of the filled frames.
+        returns the number of filled frames of head and tail-base tag
+        '''
+        oData = self.parent.oData
+        h_fis = oData.fill_gaps('hPos', max_gap)
+        tb_fis = oData.fill_gaps('tbPos', max_gap)
+        for fi in h_fis: oData[fi]['h2ac_dist'] = self.calc_h2ac_dist(oData[fi]['hPos'])[1]
+        return len(h_fis), len(tb_fis)
+
+    # --------------------------------------------------
+
+    def propagate(self, fi, tag_key, get_frame, max_frames=300, chunk_sz=30):
+        ''' re-track a tag forward and backward from a manually corrected frame ('fi'),
+        using the corrected position as the anchor.
+        Each direction stops when the result converges with existing values 
+        (two frames in a row; tracking depends on the last two positions), 
+        at another manual position, a deletion, an undetermined frame, 
+        a failed detection or after 'max_frames' frames.
+        Backward, frames are read forward in chunks of 'chunk_sz' frames 
+        and re-tracked in reverse (see read_backward).
+        get_frame: function returning the decoded frame of a frame index
+        returns frame indices, of which the tag position was changed
+        '''
+        oData = self.parent.oData
+        tag_idx = ['hPos', 'tbPos'].index(tag_key)
+        HSVmin, HSVmax = self.get_HSV_range(tag_idx)
+        stop_st = np.in1d(oData.status[tag_key], [ST_MANUAL, ST_DELETED, ST_NONE]) # another anchor or not tracked yet
+        changed = []
+        for d_ in [1, -1]: # forward and backward
+            pTagPos = oData[fi][tag_key]; ppTagPos = (None, None) # no velocity at the anchor; its neighbours might be wrong
+            n_same = 0
+            n_ = 0 # number of frames to re-track in this direction
+            fi_ = fi + d_
+            while n_ < max_frames and 1 <= fi_ <= self.parent.frame_cnt and stop_st[fi_] == False:
+                n_ += 1
+                fi_ += d_
+            if d_ == 1: frames = ( (fi_, get_frame(fi_)) for fi_ in xrange(fi+1, fi+n_+1) )
+            else: frames = self.read_backward(get_frame, fi-1, n_, chunk_sz)
+            for fi_, img in frames:
+                st = oData.status[tag_key][fi_]
+                color_func = lambda rect_, step: self.find_color(rect_, img, HSVmin, HSVmax, step)
+                cp, failed = self.locate_tag(color_func, pTagPos, ppTagPos)
+                if failed == True or cp == (-1,-1): break # lost; existing values are kept for the user to check
+                if cp == oData[fi_][tag_key] and st != ST_HELD:
+                    n_same += 1
+                    if n_same == 2: break # converged
+                else:
+                    n_same = 0
+                    oData.set(fi_, tag_key, cp, ST_OK)
+                    if tag_key == 'hPos': oData[fi_]['h2ac_dist'] = self.calc_h2ac_dist(cp)[1]
+                    changed.append(fi_)
+                ppTagPos = pTagPos; pTagPos = cp
+        return changed
+
+    # --------------------------------------------------
+
+    def read_backward(self, get_frame, fi, n_frames, chunk_sz=30):
+        ''' yields (frame index, frame) of 'n_frames' frames from 'fi' backward.
+        frames are read forward in chunks of 'chunk_sz' frames and given in reverse,
+        so that a video source seeks once per chunk, not once per frame.
+        '''
+        fi2 = fi
+        fi_end = fi - n_frames + 1
+        while fi2 >= fi_end:
+            fi1 = max(fi_end, fi2-chunk_sz+1)
+            chunk = [ get_frame(fi_) for fi_ in xrange(fi1, fi2+1) ]
+            for k in xrange(len(chunk)-1, -1, -1): yield fi1+k, chunk[k]
+            fi2 = fi1 - 1
 
     # --------------------------------------------------
 
-    def find_color(self, rect, inImage, HSV_min, HSV_max):
+    def track_batch(self, frames, fi, HSV_stack=None):
+        ''' track tags in a stack of consecutive frames without drawing.
+        frames: (N,H,W,3) uint8 array; frames[0] is the frame of index 'fi'
+        Colour classification (or HSV conversion and thresholding) of both tag colors 
+        is done in one pass over the whole stack, then tag positions are resolved
+        frame by frame on the thresholded stacks as proc_img does.
+        Results are stored in parent.oData.
+        HSV_stack: HSV converted 'frames' (N*H,W,3), when it's already made (e.g. shared by arenas)
+        returns bool array; True where a tag was not found
+        '''
+        N, H, W = frames.shape[:3]
+        self.fSize = (W, H)
+        t0 = time()
+        masks = []
+        if self.flag_lut == True:
+            cls_stack = self.classify(frames.reshape(N*H, W, 3))
+            for i in range(2): masks.append( cv2.bitwise_and(cls_stack, 1<<i).reshape(N, H, W) ) # head and tail
+        else:
+            if HSV_stack is None: HSV_stack = cv2.cvtColor(frames.reshape(N*H, W, 3), cv2.COLOR_BGR2HSV)
+            for i in range(2): # head and tail
+                HSVmin, HSVmax = self.get_HSV_range(i)
+                masks.append( cv2.inRange(HSV_stack, HSVmin, HSVmax).reshape(N, H, W) )
+        self.parent.stage_timer.add('hsv', t0)
+        oData = self.parent.oData
+        failed_arr = np.zeros(N, dtype=np.bool)
+        for k in xrange(N):
+            fi_ = fi + k
+            for i, tag_key in enumerate(['hPos', 'tbPos']):
+                tp = oData[fi_][tag_key]
+                if tp[0] != None and tp[1] != None: continue # coordinate is already determined
+                pTagPos, ppTagPos = self.get_prev_pos(fi_, tag_key)
+                color_func = lambda rect_, step: self.crop_mask(rect_, masks[i][k], step)
+                cp, failed = self.locate_tag(color_func, pTagPos, ppTagPos)
+                st = None
+                if failed == True:
+                    failed_arr[k] = True
+                    st = ST_HELD
+                oData.set(fi_, tag_key, cp, st)
+            oData[fi_]['h2ac_dist'] = self.calc_h2ac_dist(oData[fi_]['hPos'])[1]
+        return failed_arr
+
+    # --------------------------------------------------
+
+    def clip_rect(self, rect, iSize):
+        ''' clip 'rect' (x1,y1,x2,y2) into an image of size 'iSize' (height, width);
+        returns slice bounds (x1,y1,x2,y2), where x2,y2 are exclusive.
+        '''
+        x1 = max(0, rect[0]); y1 = max(0, rect[1])
+        x2 = min(iSize[1], rect[2]+1); y2 = min(iSize[0], rect[3]+1) # pixels on x2 and y2 belong to the area
+        return x1, y1, x2, y2
+
+    # --------------------------------------------------
+
+    def pad_roi(self, grey_roi, bounds, iSize):
+        ''' findContours doesn't consider the 1 pixel border of an image.
+        pad the area with zeros, where it doesn't touch the border of the whole image,
+        to get the same contours as from the whole image.
+        returns the padded area and its offset (x,y) in the whole image
+        '''
+        x1, y1, x2, y2 = bounds
+        pT = int(y1 > 0); pB = int(y2 < iSize[0]); pL = int(x1 > 0); pR = int(x2 < iSize[1])
+        grey_roi = cv2.copyMakeBorder(grey_roi, pT, pB, pL, pR, cv2.BORDER_CONSTANT, value=0)
+        return grey_roi, (x1-pL, y1-pT)
+
+    # --------------------------------------------------
+
+    def crop_mask(self, rect, mask, step=1):
+        ''' returns an area ('rect') of an already thresholded image ('mask')
+        in the same form as find_color does
+        '''
+        x1, y1, x2, y2 = self.clip_rect(rect, mask.shape)
+        if x2 <= x1 or y2 <= y1: # the area is out of the image
+            return np.zeros( (1,1), dtype=np.uint8 ), (0,0)
+        if step > 1:
+            thr_func = lambda b_, st_: np.ascontiguousarray( mask[b_[1]:b_[3]:st_, b_[0]:b_[2]:st_] )
+            return self.coarse_to_fine((x1,y1,x2,y2), mask.shape, thr_func, step)
+        return self.pad_roi(mask[y1:y2,x1:x2], (x1,y1,x2,y2), mask.shape)
+
+    # --------------------------------------------------
+
+    def find_color(self, rect, inImage, HSV_min, HSV_max, step=1, memo=None):
     # Find a color(range: 'HSV_min' ~ 'HSV_max') in an area('rect') of an image('inImage')
     # 'rect' here is (x1,y1,x2,y2)
-        pts_ = [ (rect[0], rect[1]), (rect[0], rect[3]), (rect[2], rect[3]), (rect[2], rect[1]) ] # Upper Left, Lower Left, Lower Right, Upper Right
-        mask = np.zeros( (inImage.shape[0], inImage.shape[1]) , dtype=np.uint8 )
-        tmp_grey_img = np.zeros( (inImage.shape[0], inImage.shape[1]) , dtype=np.uint8 )
-        cv2.fillConvexPoly(mask, np.asarray(pts_), 255)
-        tmp_col_img = cv2.bitwise_and(inImage, inImage, mask=mask )
-        HSV_img = cv2.cvtColor(tmp_col_img, cv2.COLOR_BGR2HSV)
-        tmp_grey_img = cv2.inRange(HSV_img, HSV_min, HSV_max)
-        ret, tmp_grey_img = cv2.threshold(tmp_grey_img, 50, 255, cv2.THRESH_BINARY)
-        return tmp_grey_img
+    # Only the area is converted and thresholded. 
+    # With 'step' > 1, coarse to fine search (see coarse_to_fine).
+    # Converted areas are kept in 'memo' (dict), if given, 
+    # so that the same area of the same image is converted only once for both tags.
+    # Returns the greyscale result of the area and its offset (x,y) in 'inImage'.
+        x1, y1, x2, y2 = self.clip_rect(rect, inImage.shape)
+        if x2 <= x1 or y2 <= y1: # the area is out of the image
+            return np.zeros( (1,1), dtype=np.uint8 ), (0,0)
+        def thr_func(b_, st_):
+            k_ = (b_, st_)
+            if memo != None and k_ in memo: HSV_img = memo[k_]
+            else:
+                if st_ == 1: HSV_img = cv2.cvtColor(inImage[b_[1]:b_[3], b_[0]:b_[2]], cv2.COLOR_BGR2HSV)
+                else: HSV_img = cv2.cvtColor(np.ascontiguousarray(inImage[b_[1]:b_[3]:st_, b_[0]:b_[2]:st_]), cv2.COLOR_BGR2HSV)
+                if memo != None: memo[k_] = HSV_img
+            return cv2.inRange(HSV_img, HSV_min, HSV_max)
+        if step > 1: return self.coarse_to_fine((x1,y1,x2,y2), inImage.shape, thr_func, step)
+        return self.pad_roi(thr_func((x1,y1,x2,y2), 1), (x1,y1,x2,y2), inImage.shape)
+
+    # --------------------------------------------------
+
+    def get_color_lut(self):
+        ''' returns the colour class lookup table of the session.
+        index: B | G<<8 | R<<16 (24 bit BGR color), 
+        value: bit 0 (1) is set when the color is in the head tag range, bit 1 (2) for the tail-base tag.
+        It's made once (HSV conversion of all the 2^24 colors) and shared in the process.
+        '''
+        if self.lut_sString == self.parent.sString: return self.lut # same session
+        key = ( self.get_HSV_range(0), self.get_HSV_range(1) )
+        if key not in color_luts:
+            idx = np.arange(1<<24, dtype=np.uint32)
+            all_colors = np.empty( (1<<24, 3), dtype=np.uint8 )
+            all_colors[:,0] = idx & 255; all_colors[:,1] = (idx>>8) & 255; all_colors[:,2] = idx>>16
+            HSV_all = cv2.cvtColor(all_colors.reshape(4096, 4096, 3), cv2.COLOR_BGR2HSV)
+            lut = np.zeros( (4096, 4096), dtype=np.uint8 )
+            for i in range(2): # head and tail
+                HSVmin, HSVmax = key[i]
+                lut |= cv2.inRange(HSV_all, HSVmin, HSVmax) & (1<<i)
+            color_luts[key] = lut.ravel()
+        self.lut = color_luts[key]
+        self.lut_sString = self.parent.sString
+        return self.lut
+
+    # --------------------------------------------------
+
+    def classify(self, bgr_img):
+        ''' returns colour classes (see get_color_lut) of pixels of a BGR image
+        '''
+        lut = self.get_color_lut()
+        bgra = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2BGRA)
+        return lut.take( bgra.view(np.uint32)[:,:,0] & 0xFFFFFF ) # B | G<<8 | R<<16 on little endian
+
+    # --------------------------------------------------
+
+    def find_class(self, rect, inImage, cls_bit, step=1, memo=None):
+    # Find a tag color (colour class bit 'cls_bit'; see get_color_lut) in an area('rect') of an image('inImage').
+    # Same as find_color except that the lookup table is used instead of HSV conversion.
+    # Classified areas are kept in 'memo' (dict), if given, 
+    # so that the same area of the same image is classified only once for both tags.
+        x1, y1, x2, y2 = self.clip_rect(rect, inImage.shape)
+        if x2 <= x1 or y2 <= y1: # the area is out of the image
+            return np.zeros( (1,1), dtype=np.uint8 ), (0,0)
+        def thr_func(b_, st_):
+            k_ = (b_, st_)
+            if memo != None and k_ in memo: cls_img = memo[k_]
+            else:
+                if st_ == 1: cls_img = self.classify(inImage[b_[1]:b_[3], b_[0]:b_[2]])
+                else: cls_img = self.classify(np.ascontiguousarray(inImage[b_[1]:b_[3]:st_, b_[0]:b_[2]:st_]))
+                if memo != None: memo[k_] = cls_img
+            return cv2.bitwise_and(cls_img, cls_bit)
+        if step > 1: return self.coarse_to_fine((x1,y1,x2,y2), inImage.shape, thr_func, step)
+        return self.pad_roi(thr_func((x1,y1,x2,y2), 1), (x1,y1,x2,y2), inImage.shape)
+
+    # --------------------------------------------------
+
+    def coarse_to_fine(self, bounds, iSize, thr_func, step):
+        ''' color detection in a large area ('bounds'; x1,y1,x2,y2 with exclusive x2,y2), 
+        first on every 'step'-th pixel, then in full resolution 
+        only around the blobs found in the coarse result.
+        thr_func: function taking bounds and a step, 
+          returning the thresholded image of the area sampled every 'step' pixels
+        returns the same as find_color; the result is zero outside the refined areas.
+        '''
+        x1, y1, x2, y2 = bounds
+        c_mask = thr_func(bounds, step)
+        if cv2.countNonZero(c_mask) == 0: return np.zeros( (1,1), dtype=np.uint8 ), (0,0)
+        areas = [] # areas to refine in full resolution
+        for br in self.get_blob_rects(c_mask.copy()):
+            areas.append( ( max(x1, x1+(br[0]-1)*step), max(y1, y1+(br[1]-1)*step), 
+                            min(x2, x1+(br[0]+br[2]+1)*step), min(y2, y1+(br[1]+br[3]+1)*step) ) ) # one coarse pixel of margin
+        rx1 = min([ a_[0] for a_ in areas ]); ry1 = min([ a_[1] for a_ in areas ])
+        rx2 = max([ a_[2] for a_ in areas ]); ry2 = max([ a_[3] for a_ in areas ])
+        grey_img = np.zeros( (ry2-ry1, rx2-rx1), dtype=np.uint8 )
+        for a_ in areas:
+            grey_img[a_[1]-ry1:a_[3]-ry1, a_[0]-rx1:a_[2]-rx1] = thr_func(a_, 1)
+        return self.pad_roi(grey_img, (rx1,ry1,rx2,ry2), iSize)
 
     # --------------------------------------------------
     
@@ -160,29 +495,78 @@ class CVProc:
 
     # --------------------------------------------------
 
-    def chk_contours(self, inImage, contour_threshold):
-        contours, hierarchy = cv2.findContours(inImage, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        wrect = [-1,-1,-1,-1] # whole rect, bounding all the contours
-        rects = [] # rects, bounding each contour piece
-        for ci in xrange(len(contours)):
-            #M = cv2.moments(contours[ci])
-            br = cv2.boundingRect(contours[ci])
-            if br[2] + br[3] > contour_threshold:
-                if wrect[0] == -1 and wrect[1] == -1: wrect[0] = br[0]; wrect[1] = br[1]
-                if wrect[2] == -1 and wrect[3] == -1: wrect[2] = br[0]; wrect[3] = br[1]
-                if br[0] < wrect[0]: wrect[0] = br[0]
-                if br[1] < wrect[1]: wrect[1] = br[1]
-                if (br[0]+br[2]) > wrect[2]: wrect[2] = br[0]+br[2]
-                if (br[1]+br[3]) > wrect[3]: wrect[3] = br[1]+br[3]
-                rects.append(br)
-        wrect[2] = wrect[2]-wrect[0]
-        wrect[3] = wrect[3]-wrect[1]
-        return tuple(wrect), rects
+    def get_blob_rects(self, grey_img):
+        ''' returns bounding rects (x,y,w,h) of blobs (8-connected) in a binary image as (N,4) array.
+        'grey_img' can be modified (findContours of OpenCV 2.4).
+        '''
+        contours = cv2.findContours(grey_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2] # outer contours only; OpenCV 3 returns 3 values
+        if len(contours) == 0: return np.zeros( (0,4), dtype=np.int32 )
+        if len(contours) < 8: return np.array([ cv2.boundingRect(c_) for c_ in contours ], dtype=np.int32) # cheaper than array operations for a few blobs
+        pts = np.concatenate(contours).reshape(-1,2)
+        starts = np.cumsum( [0] + [ len(c_) for c_ in contours[:-1] ] ) # index of the first point of each contour
+        x1 = np.minimum.reduceat(pts[:,0], starts); x2 = np.maximum.reduceat(pts[:,0], starts)
+        y1 = np.minimum.reduceat(pts[:,1], starts); y2 = np.maximum.reduceat(pts[:,1], starts)
+        return np.column_stack( (x1, y1, x2-x1+1, y2-y1+1) ) # same as cv2.boundingRect of each contour
+
+    # --------------------------------------------------
+
+    def get_blob_center(self, grey_img, contour_threshold, offset=(0,0)):
+    # Returns the median of center points of the bounding rects of blobs in 'grey_img',
+    # whose width+height is larger than 'contour_threshold', or (-1,-1) when there's none.
+    # 'offset' is (x,y) of 'grey_img' in the whole frame; the point is in frame coordinates.
+        rects = self.get_blob_rects(grey_img)
+        rects = rects[ rects[:,2]+rects[:,3] > contour_threshold ]
+        if len(rects) == 0: return (-1, -1)
+        if len(rects) == 1: return ( int(rects[0,0]+offset[0]+rects[0,2]//2), int(rects[0,1]+offset[1]+rects[0,3]//2) ) # usual case; a single blob
+        cp_x = rects[:,0] + offset[0] + rects[:,2]//2
+        cp_y = rects[:,1] + offset[1] + rects[:,3]//2
+        return ( int(np.median(cp_x)), int(np.median(cp_y)) )
     
     # --------------------------------------------------
 
 # ======================================================
 
+class VideoWriterThread(Thread):
+    ''' Resizes frames and writes them into a video file in a separate thread.
+    Frames are passed through a bounded queue in order;
+    write() blocks when the queue is full (the encoder falls behind).
+    A frame must not be modified after it's passed to write().
+    '''
+    def __init__(self, video_fp, fourcc, fps, fSize, q_size=30, stage_timer=None):
+        Thread.__init__(self)
+        self.fSize = fSize # output video frame size
+        self.stage_timer = stage_timer
+        self.video_rec = cv2.VideoWriter( video_fp, fourcc, fps, fSize, 1 )
+        self.q = Queue.Queue(maxsize=q_size)
+        self.setDaemon(True)
+        self.start()
+
+    # --------------------------------------------------
+
+    def write(self, frame_arr):
+        self.q.put(frame_arr)
+
+    # --------------------------------------------------
+
+    def run(self):
+        while True:
+            frame_arr = self.q.get()
+            if frame_arr is None: break # release() was called
+            t0 = time()
+            self.video_rec.write( cv2.resize(frame_arr, self.fSize) )
+            if self.stage_timer != None: self.stage_timer.add('encode', t0)
+
+    # --------------------------------------------------
+
+    def release(self):
+        ''' write remaining frames in the queue and close the video file
+        '''
+        self.q.put(None)
+        self.join()
+        self.video_rec.release()
+
+# ======================================================
+
 if __name__ == '__main__':
     pass
 
@@ -0,0 +1,421 @@
+from os import path, remove
+from glob import glob
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
+from time import time, sleep
+
+import cv2
+import numpy as np
+
+from modules.base_funcs import load_cv_img
+
+video_exts = ['.mp4', '.avi', '.mov', '.mkv', '.m4v', '.mpg', '.mpeg'] # video files, which can be opened as a session
+if hasattr(cv2, 'CAP_PROP_POS_MSEC'): # OpenCV 3 or later
+    CAP_POS_MSEC = cv2.CAP_PROP_POS_MSEC
+    CAP_POS_FRAMES = cv2.CAP_PROP_POS_FRAMES
+    CAP_FRAME_COUNT = cv2.CAP_PROP_FRAME_COUNT
+else: # OpenCV 2.4
+    CAP_POS_MSEC = cv2.cv.CV_CAP_PROP_POS_MSEC
+    CAP_POS_FRAMES = cv2.cv.CV_CAP_PROP_POS_FRAMES
+    CAP_FRAME_COUNT = cv2.cv.CV_CAP_PROP_FRAME_COUNT
+
+# ======================================================
+
+class FolderSource:
+    ''' Frames of a session from a folder of JPEG images 
+    (f000001.jpg, f000002.jpg, ..)
+    '''
+    def __init__(self, fPath):
+        self.fPath = fPath
+        self.frame_cnt = len(glob(path.join(self.fPath, '*.jpg')))
+
+    # --------------------------------------------------
+
+    def read(self, fi):
+        return load_cv_img(path.join(self.fPath, 'f%06i.jpg'%fi))
+
+    # --------------------------------------------------
+
+    def release(self):
+        pass
+
+# ======================================================
+
+class VideoSource:
+    ''' Frames of a session directly from a video file.
+    Frame index starts from 1 as in FolderSource.
+    Sequential reads just decode the next frame.
+    For jumps, a seek index (<video>.idx.npz; timestamp of every frame),
+    which is made once by scanning the video and kept, is used
+    to verify where the capture landed after seeking,
+    so that a jump always lands exactly on the requested frame.
+    '''
+    def __init__(self, fp):
+        self.fp = fp
+        self.idx_fp = fp + '.idx.npz'
+        self.cap = cv2.VideoCapture(fp)
+        self.ts = self.load_index() # timestamps (msec) of frames
+        if self.ts is None: self.ts = self.make_index()
+        self.frame_cnt = len(self.ts)
+        if self.frame_cnt > 1: self.f_intv = float(np.median(np.diff(self.ts))) # frame interval (msec)
+        else: self.f_intv = 1.0
+        self.cur_fi = 0 # frame index, which was grabbed last
+
+    # --------------------------------------------------
+
+    def load_index(self):
+        ''' returns timestamps from the seek index file,
+        or None if it doesn't exist or it's not for the current video file
+        '''
+        if path.isfile(self.idx_fp) == False: return None
+        try:
+            npz = np.load(self.idx_fp)
+            if int(npz['v_size']) != path.getsize(self.fp) or float(npz['v_mtime']) != path.getmtime(self.fp): return None
+            ts = npz['ts']
+            npz.close()
+        except Exception:
+            return None
+        return ts
+
+    # --------------------------------------------------
+
+    def make_index(self):
+        ''' scan all the frames and keep their timestamps in the seek index file
+        '''
+        ts = []
+        while self.cap.grab() == True: ts.append( self.cap.get(CAP_POS_MSEC) )
+        ts = np.array(ts, dtype=np.float64)
+        try:
+            np.savez(self.idx_fp, ts=ts, v_size=np.array(path.getsize(self.fp)), v_mtime=np.array(path.getmtime(self.fp)))
+        except IOError: # no permission to write next to the video; the index will be made again next time
+            pass
+        self.reopen()
+        return ts
+
+    # --------------------------------------------------
+
+    def reopen(self):
+        self.cap.release()
+        self.cap = cv2.VideoCapture(self.fp)
+        self.cur_fi = 0
+
+    # --------------------------------------------------
+
+    def ts_to_fi(self, ts):
+        ''' returns the frame index of a timestamp
+        '''
+        i = int(np.searchsorted(self.ts, ts - self.f_intv/2))
+        return min(i, self.frame_cnt-1) + 1
+
+    # --------------------------------------------------
+
+    def seek(self, fi):
+        ''' grab the frame of 'fi'
+        '''
+        if fi < self.cur_fi or fi > self.cur_fi + 60: # seeking is faster than grabbing frames one by one
+            back = 0 # how many frames to land before 'fi'
+            while True:
+                start = max(1, fi-back)
+                if start == 1: # read from the beginning
+                    self.reopen()
+                    break
+                self.cap.set(CAP_POS_FRAMES, start-1)
+                if self.cap.grab() == False: 
+                    self.reopen()
+                    break
+                self.cur_fi = self.ts_to_fi( self.cap.get(CAP_POS_MSEC) ) # where it actually landed
+                if self.cur_fi <= fi: break
+                back = max(back*2, 30) # landed after 'fi'; try landing earlier
+        while self.cur_fi < fi:
+            if self.cap.grab() == False: break
+            self.cur_fi += 1
+
+    # --------------------------------------------------
+
+    def read(self, fi):
+        if fi != self.cur_fi: self.seek(fi)
+        ret, img = self.cap.retrieve()
+        return img
+
+    # --------------------------------------------------
+
+    def release(self):
+        self.cap.release()
+
+# ======================================================
+
+def open_frame_src(fp):
+    ''' returns FolderSource or VideoSource for a session path
+    '''
+    if path.isdir(fp) == True: return FolderSource(fp)
+    return VideoSource(fp)
+
+# --------------------------------------------
+
+def get_result_base(fp):
+    ''' returns the base path of result files (<base>.csv, <base>.avi, ..)
+    of a session; folder path itself or video file path without its extension
+    '''
+    if path.isdir(fp) == True: return fp.rstrip('/')
+    return path.splitext(fp)[0]
+
+# --------------------------------------------
+
+def get_video_out_path(fp):
+    ''' returns the path of the annotated output video of a session
+    '''
+    video_path = get_result_base(fp) + '.avi'
+    if video_path == fp: video_path = get_result_base(fp) + '_ama.avi' # don't overwrite the input video
+    return video_path
+
+# ======================================================
+
+class FramePrefetcher:
+    ''' Decodes frames ahead of the current frame index
+    in a background thread, so that decoding overlaps
+    with detection and drawing of the current frame.
+    '''
+    def __init__(self, frame_src, n_ahead=8, stage_timer=None):
+        self.frame_src = frame_src # FolderSource or VideoSource
+        self.stage_timer = stage_timer
+        self.frame_cnt = frame_src.frame_cnt
+        self.src_lock = Lock() # frame source is read from two threads
+        self.n_ahead = n_ahead # number of frames to decode ahead
+        self.frames = {} # decoded frames; key: frame index
+        self.fi = 0 # frame index, which was requested last
+        self.gen = 0 # generation; increases when the read-ahead window is invalidated
+        self.loading = -1 # frame index, which is being decoded in the thread
+        self.cond = Condition()
+        self.is_running = True
+        self.th = Thread(target=self.run)
+        self.th.setDaemon(True)
+        self.th.start()
+
+    # --------------------------------------------------
+
+    def load(self, fi):
+        self.src_lock.acquire()
+        try:
+            t0 = time()
+            img = self.frame_src.read(fi)
+            if self.stage_timer != None: self.stage_timer.add('decode', t0)
+        finally:
+            self.src_lock.release()
+        return img
+
+    # --------------------------------------------------
+
+    def get(self, fi):
+        ''' returns the decoded frame of 'fi' and
+        moves the read-ahead window to fi+1 ~ fi+n_ahead
+        '''
+        img = self.move(fi)
+        if img is None: img = self.load(fi) # not prefetched yet
+        return img
+
+    # --------------------------------------------------
+
+    def move(self, fi):
+        ''' moves the read-ahead window to fi+1 ~ fi+n_ahead
+        (e.g. when the frame of 'fi' is already available elsewhere)
+        returns the decoded frame of 'fi', if it's prefetched, or None
+        '''
+        self.cond.acquire()
+        if fi == self.fi: pass # same frame again (e.g. after mouse click); read-ahead window stays
+        elif fi != self.fi+1: # jumped (or went backward); decoded frames are no longer useful
+            self.frames = {}
+            self.gen += 1
+        else:
+            while self.loading == fi and fi not in self.frames: self.cond.wait() # it's being decoded right now
+        img = self.frames.pop(fi, None)
+        self.fi = fi
+        self.cond.notify_all()
+        self.cond.release()
+        return img
+
+    # --------------------------------------------------
+
+    def next_to_load(self):
+        ''' returns the first frame index in the read-ahead window,
+        which is not decoded yet (-1 when the window is full)
+        '''
+        for fi in range(self.fi+1, min(self.fi+self.n_ahead, self.frame_cnt)+1):
+            if fi not in self.frames: return fi
+        return -1
+
+    # --------------------------------------------------
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            fi = self.next_to_load()
+            while self.is_running == True and fi == -1:
+                self.cond.wait()
+                fi = self.next_to_load()
+            gen = self.gen
+            self.loading = fi
+            self.cond.release()
+            if self.is_running == False: break
+            img = self.load(fi) # decode without holding the lock
+            self.cond.acquire()
+            if gen == self.gen and self.fi < fi <= self.fi+self.n_ahead: self.frames[fi] = img
+            self.loading = -1
+            self.cond.notify_all()
+            self.cond.release()
+
+    # --------------------------------------------------
+
+    def stop(self):
+        self.cond.acquire()
+        self.is_running = False
+        self.cond.notify_all()
+        self.cond.release()
+        self.th.join()
+        self.frames = {}
+
+# ======================================================
+
+class FrameCache:
+    ''' Memory bounded LRU cache of processed frames.
+    key: frame index
+    value: any object (e.g. a dict with decoded & annotated frames)
+    '''
+    def __init__(self, max_mb=512):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.n_bytes = 0 # currently used bytes
+        self.items = OrderedDict() # key: frame index, value: (item, bytes); the last one is the most recently used
+
+    # --------------------------------------------------
+
+    def get(self, fi):
+        if fi not in self.items: return None
+        item, nb = self.items.pop(fi)
+        self.items[fi] = (item, nb) # move to the end (most recently used)
+        return item
+
+    # --------------------------------------------------
+
+    def put(self, fi, item, nb):
+        ''' store 'item' of 'fi', which uses 'nb' bytes of memory
+        '''
+        if fi in self.items: self.n_bytes -= self.items.pop(fi)[1]
+        self.items[fi] = (item, nb)
+        self.n_bytes += nb
+        while self.n_bytes > self.max_bytes and len(self.items) > 1: # remove least recently used items
+            k_, (item_, nb_) = self.items.popitem(last=False)
+            self.n_bytes -= nb_
+
+    # --------------------------------------------------
+
+    def clear(self):
+        self.items = OrderedDict()
+        self.n_bytes = 0
+
+# ======================================================
+
+class PreviewStore:
+    ''' Downscaled preview images of a session, one per 'step' frames,
+    kept as JPEG data in a single file (<fPath>.preview.jpgs)
+    with an offset table (<fPath>.preview.idx.npy).
+    It's built lazily in a background thread (with its own frame source)
+    and kept for the next time the session is opened.
+    Row 0 of the offset table is the preview size (width, height) and
+    row 1+si is the offset and length of the JPEG data of slot 'si' (length 0: not built yet).
+    '''
+    def __init__(self, src_path, base_fp, frame_cnt, step=10, scale=0.25, quality=80):
+        self.src_path = src_path # folder path or video file path
+        self.base_fp = base_fp
+        self.fp = base_fp + '.preview.jpgs'
+        self.idx_fp = base_fp + '.preview.idx.npy'
+        self.frame_cnt = frame_cnt
+        self.step = step
+        self.scale = scale
+        self.quality = quality # JPEG quality of preview images
+        self.n_slots = (frame_cnt-1)/step + 1
+        self.pSize = None # (width, height) of a preview image
+        self.idx = None # memory mapped offset table
+        self.fh = None # file of JPEG data, opened for reading previews
+        self.is_running = True
+        self.th = Thread(target=self.run)
+        self.th.setDaemon(True)
+        self.th.start()
+
+    # --------------------------------------------------
+
+    def open_store(self, img):
+        ''' open the preview files, or make new ones 
+        when they don't exist or don't match the current session
+        '''
+        pSize = ( max(1, int(img.shape[1]*self.scale)), max(1, int(img.shape[0]*self.scale)) )
+        shape = (self.n_slots+1, 2)
+        idx = None
+        if path.isfile(self.idx_fp) == True and path.isfile(self.fp) == True:
+            try:
+                idx = np.load(self.idx_fp, mmap_mode='r+')
+                if idx.shape != shape or idx.dtype != np.int64 or tuple(idx[0]) != pSize: idx = None
+                else: idx[1:][ idx[1:,0]+idx[1:,1] > path.getsize(self.fp) ] = 0 # JPEG data was not written completely (e.g. crash)
+            except Exception:
+                idx = None
+        if idx is None:
+            idx = np.lib.format.open_memmap(self.idx_fp, mode='w+', dtype=np.int64, shape=shape)
+            idx[0] = pSize
+            open(self.fp, 'wb').close()
+        old_fp = self.base_fp + '.preview.npy' # uncompressed previews of an older version
+        if path.isfile(old_fp) == True: remove(old_fp)
+        self.pSize = pSize
+        self.fh = open(self.fp, 'rb')
+        self.idx = idx
+
+    # --------------------------------------------------
+
+    def run(self):
+        frame_src = open_frame_src(self.src_path)
+        try:
+            self.open_store( frame_src.read(1) )
+            wfh = open(self.fp, 'r+b')
+        except Exception: # e.g. no permission to write the preview file
+            frame_src.release()
+            return
+        wfh.seek(0, 2)
+        offset = wfh.tell()
+        for si in xrange(self.n_slots):
+            if self.is_running == False: break
+            if self.idx[si+1,1] > 0: continue # already built
+            img = frame_src.read(si*self.step+1)
+            if img is None: break
+            pImg = cv2.resize(img, self.pSize, interpolation=cv2.INTER_AREA)
+            buf = cv2.imencode('.jpg', pImg, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1].tostring()
+            wfh.write(buf)
+            wfh.flush() # data is in the file before the offset table points to it
+            self.idx[si+1] = (offset, len(buf))
+            offset += len(buf)
+            if si % 100 == 0: self.idx.flush()
+            sleep(0.001) # give way to the main thread
+        wfh.close()
+        self.idx.flush()
+        frame_src.release()
+
+    # --------------------------------------------------
+
+    def get(self, fi):
+        ''' returns the preview image nearest to 'fi' 
+        or None if it's not built yet
+        '''
+        if self.idx is None: return None
+        si = min(self.n_slots-1, int(round((fi-1)/float(self.step))))
+        offset, length = self.idx[si+1]
+        if length == 0: return None
+        self.fh.seek(offset)
+        return cv2.imdecode(np.frombuffer(self.fh.read(length), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    # --------------------------------------------------
+
+    def stop(self):
+        self.is_running = False
+        self.th.join()
+        self.idx = None
+        if self.fh != None: self.fh.close()
+        self.fh = None
+
+# ======================================================
+
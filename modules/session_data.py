@@ -0,0 +1,491 @@
+from os import path, rename, remove
+from threading import Lock
+
+import numpy as np
+
+### status codes of a tag position
+ST_NONE = 0 # not determined yet; (None, None)
+ST_OK = 1 # position is available
+ST_DELETED = 2 # intentionally deleted by the user; ('D', 'D')
+ST_FAILED = 3 # detection failed (tag was not found and there was no previous position to keep); (-1, -1)
+ST_MANUAL = 4 # position is set by the user (mouse click)
+ST_INTERP = 5 # position is interpolated over a short gap of failed detections (fill_gaps)
+ST_HELD = 6 # tag was not found; the position of the previous frame is kept
+pos_status = [ST_OK, ST_MANUAL, ST_INTERP, ST_HELD] # status codes, with which the position is available
+gap_status = [ST_FAILED, ST_HELD] # status codes of failed detections, which can be interpolated (fill_gaps)
+
+# ======================================================
+
+class SessionData:
+    ''' Output data of a session, stored in arrays indexed by
+    frame index (index 0 is not used).
+    Tag positions are int arrays with a status code array per tag.
+    h2ac_dist is an int array, where -1 means None.
+    oData[fi]['hPos'] style access (get & set) is kept through FrameData,
+    so that values are still exchanged as tuples such as (x, y), 
+    (None, None), ('D', 'D') or (-1, -1).
+    '''
+    tag_keys = ['hPos', 'tbPos'] # hPos: head tag position, tbPos: tail-base tag position
+
+    def __init__(self, frame_cnt):
+        self.frame_cnt = frame_cnt
+        self.pos = {} # tag positions; each is (frame_cnt+1, 2) array of x,y
+        self.status = {} # status code of tag positions
+        for key in self.tag_keys:
+            self.pos[key] = np.zeros( (frame_cnt+1, 2), dtype=np.int32 )
+            self.status[key] = np.zeros( frame_cnt+1, dtype=np.int8 ) + ST_NONE
+        self.dist = np.zeros( frame_cnt+1, dtype=np.int32 ) - 1 # distance from the head tag to the arena center
+        self.p_rect = None # arena rect (x1,y1,x2,y2) of CVProc, with which the session was tracked; kept in npz only
+        self.journal = None # EditJournal; when it's set, every change is appended to it
+        self.lock = Lock()
+
+    # --------------------------------------------------
+
+    def __len__(self):
+        return self.frame_cnt
+
+    # --------------------------------------------------
+
+    def __contains__(self, fi):
+        return 1 <= fi <= self.frame_cnt
+
+    # --------------------------------------------------
+
+    def __getitem__(self, fi):
+        if not 1 <= fi <= self.frame_cnt: raise KeyError(fi)
+        return FrameData(self, fi)
+
+    # --------------------------------------------------
+
+    def get(self, fi, key):
+        if key == 'h2ac_dist':
+            if self.dist[fi] < 0: return None
+            return int(self.dist[fi])
+        st = self.status[key][fi]
+        if st in pos_status: return ( int(self.pos[key][fi,0]), int(self.pos[key][fi,1]) )
+        elif st == ST_NONE: return (None, None)
+        elif st == ST_DELETED: return ('D', 'D')
+        elif st == ST_FAILED: return (-1, -1)
+
+    # --------------------------------------------------
+
+    def set(self, fi, key, val, st=None):
+        ''' st: status code of a position value (ST_OK, ST_MANUAL, ST_INTERP or ST_HELD).
+          if it's None, the status of an unchanged position is kept 
+          (e.g. a manual position stays manual when the frame is processed again),
+          otherwise it's ST_OK.
+        '''
+        self.lock.acquire()
+        try:
+            if key != 'h2ac_dist' and val[0] not in [None, 'D'] and tuple(val) != (-1, -1):
+                if st == None:
+                    if self.status[key][fi] in pos_status and tuple(val) == self.get(fi, key): st = self.status[key][fi]
+                    else: st = ST_OK
+            else: st = None
+            if self.journal != None:
+                if key == 'h2ac_dist': changed = (val != self.get(fi, key))
+                else: changed = (tuple(val) != self.get(fi, key) or (st != None and st != self.status[key][fi]))
+                if changed == True: self.journal.write(fi, key, val, st)
+            if key == 'h2ac_dist':
+                if val == None: self.dist[fi] = -1
+                else: self.dist[fi] = val
+            elif val[0] == None: self.status[key][fi] = ST_NONE
+            elif val[0] == 'D': self.status[key][fi] = ST_DELETED
+            elif val[0] == -1 and val[1] == -1: self.status[key][fi] = ST_FAILED
+            else:
+                self.pos[key][fi] = val
+                self.status[key][fi] = st
+        finally:
+            self.lock.release()
+
+    # --------------------------------------------------
+
+    def snapshot(self):
+        ''' returns a copy of the data (without journal).
+        the journal is rotated at the same time, 
+        so that the copy includes all the edits in the rotated journal.
+        '''
+        self.lock.acquire()
+        try:
+            sd = SessionData(self.frame_cnt)
+            sd.dist[:] = self.dist
+            if self.p_rect != None: sd.p_rect = list(self.p_rect)
+            for key in self.tag_keys:
+                sd.pos[key][:] = self.pos[key]
+                sd.status[key][:] = self.status[key]
+            if self.journal != None: self.journal.rotate()
+        finally:
+            self.lock.release()
+        return sd
+
+    # --------------------------------------------------
+
+    def get_xy(self, key):
+        ''' returns x,y array of a tag for all frames,
+        where failed detections are (-1, -1) as in the output CSV
+        '''
+        xy = self.pos[key].copy()
+        xy[self.status[key] == ST_FAILED] = -1
+        return xy
+
+    # --------------------------------------------------
+
+    def is_int(self, key):
+        ''' returns bool array; True where the tag position is (int, int),
+        including failed detections of (-1, -1)
+        '''
+        return self.has_pos(key) | (self.status[key] == ST_FAILED)
+
+    # --------------------------------------------------
+
+    def has_pos(self, key):
+        ''' returns bool array; True where the tag position is available
+        (detected, set by the user or interpolated)
+        '''
+        return np.in1d(self.status[key], pos_status)
+
+    # --------------------------------------------------
+
+    def fill_gaps(self, key, max_gap):
+        ''' interpolate positions of a tag over runs of failed detections
+        ((-1, -1) or the kept previous position; gap_status), which are not longer than 'max_gap' frames and bounded by
+        detected (or manual) positions on both sides.
+        filled positions get ST_INTERP. other frames (such as 'D' deletions) are not touched.
+        returns frame indices of the filled frames
+        '''
+        self.lock.acquire()
+        try:
+            st = self.status[key]
+            failed = np.concatenate( ([0], np.in1d(st[1:], gap_status).astype(np.int8), [0]) )
+            d_ = np.diff(failed)
+            starts = np.where(d_ == 1)[0] + 1 # first frame of each run
+            ends = np.where(d_ == -1)[0] + 1 # frame right after each run
+            reliable = np.concatenate( ((st == ST_OK) | (st == ST_MANUAL), [False]) )
+            sel = (ends-starts <= max_gap) & reliable[starts-1] & reliable[ends]
+            starts = starts[sel]; ends = ends[sel]
+            if len(starts) == 0: return np.zeros(0, dtype=np.int64)
+            lens = ends - starts
+            fis = np.repeat(starts-np.cumsum(np.concatenate(([0], lens[:-1]))), lens) + np.arange(lens.sum()) # all frames of the runs
+            anchors = np.unique( np.concatenate((starts-1, ends)) ) # positions around the runs
+            xy = np.empty( (len(fis), 2), dtype=np.int32 )
+            for i in range(2): xy[:,i] = np.round( np.interp(fis, anchors, self.pos[key][anchors,i]) )
+            self.pos[key][fis] = xy
+            st[fis] = ST_INTERP
+            if self.journal != None:
+                for k in xrange(len(fis)): self.journal.write(fis[k], key, tuple(xy[k]), ST_INTERP)
+        finally:
+            self.lock.release()
+        return fis
+
+# ======================================================
+
+class FrameData:
+    ''' dict-like view of one frame of SessionData
+    '''
+    def __init__(self, sData, fi):
+        self.sData = sData
+        self.fi = fi
+
+    def __getitem__(self, key):
+        return self.sData.get(self.fi, key)
+
+    def __setitem__(self, key, val):
+        self.sData.set(self.fi, key, val)
+
+# ======================================================
+
+class EditJournal:
+    ''' Append-only journal (<base>.jnl) of changes of SessionData.
+    Each line is 'frame-index,key,value(s)[,status]'.
+    The journal is periodically compacted into <base>.autosave.npz 
+    (compact_result) and replayed on top of it when the session 
+    is opened again (load_result), so unsaved work survives a crash.
+    '''
+    def __init__(self, base_fp):
+        self.fp = base_fp + '.jnl'
+        self.old_fp = base_fp + '.jnl.old' # rotated journal, which is being compacted
+        self.autosave_fp = base_fp + '.autosave.npz'
+        self.fh = open(self.fp, 'a')
+        self.n_edits = 0 # number of edits since the last rotation
+
+    # --------------------------------------------------
+
+    def write(self, fi, key, val, st=None):
+        if key == 'h2ac_dist': line = '%i,%s,%s\n'%(fi, key, str(val))
+        elif st in [ST_MANUAL, ST_INTERP, ST_HELD]: line = '%i,%s,%s,%s,%i\n'%(fi, key, str(val[0]), str(val[1]), st) # status is written only when it's not ST_OK
+        else: line = '%i,%s,%s,%s\n'%(fi, key, str(val[0]), str(val[1]))
+        self.fh.write(line)
+        self.fh.flush()
+        self.n_edits += 1
+
+    # --------------------------------------------------
+
+    def rotate(self):
+        ''' move the current journal to <base>.jnl.old and start a new one
+        '''
+        self.fh.close()
+        if path.isfile(self.old_fp) == True: # previous compaction didn't finish; keep its edits as well
+            f = open(self.fp, 'r'); txt = f.read(); f.close()
+            f = open(self.old_fp, 'a'); f.write(txt); f.close()
+            remove(self.fp)
+        else:
+            rename(self.fp, self.old_fp)
+        self.fh = open(self.fp, 'a')
+        self.n_edits = 0
+
+    # --------------------------------------------------
+
+    def remove_old(self):
+        if path.isfile(self.old_fp) == True: remove(self.old_fp)
+
+    # --------------------------------------------------
+
+    def close(self, discard=False):
+        ''' close the journal.
+        discard: remove the journal and autosaved data as well
+        '''
+        self.fh.close()
+        if discard == True:
+            for fp in [self.fp, self.old_fp, self.autosave_fp]:
+                if path.isfile(fp) == True: remove(fp)
+
+# ======================================================
+
+def replay_journal(oData, base_fp):
+    ''' apply edits in <base_fp>.jnl.old and <base_fp>.jnl to 'oData'
+    '''
+    def to_val(str_):
+        if str_ == 'None': return None
+        elif str_ == 'D': return 'D'
+        else: return int(str_)
+    for fp in [base_fp + '.jnl.old', base_fp + '.jnl']:
+        if path.isfile(fp) == False: continue
+        f = open(fp, 'r')
+        for line in f:
+            items = line.strip().split(',')
+            try:
+                fi = int(items[0])
+                st = None
+                if items[1] == 'h2ac_dist': val = to_val(items[2])
+                else:
+                    val = ( to_val(items[2]), to_val(items[3]) )
+                    if len(items) > 4: st = int(items[4])
+                    elif val[0] not in [None, 'D']: st = ST_OK
+                oData.set(fi, items[1], val, st)
+            except Exception: # incomplete last line (crash while writing) or broken line
+                continue
+        f.close()
+
+# ======================================================
+
+def read_result_csv(csv_fp, frame_cnt):
+    ''' returns output data (SessionData) loaded from a result CSV file.
+    if the file doesn't exist, all positions are undetermined.
+    '''
+    oData = SessionData(frame_cnt)
+    if path.isfile(csv_fp) == False: return oData
+    f = open(csv_fp, 'r')
+    lines = f.readlines()
+    f.close()
+    for i in range(1, frame_cnt+1):
+        if i < len(lines):
+            items = [ x.strip() for x in lines[i].split(',') ]
+            idx_ = int(items[0])
+            if items[1] == 'None': hPos_val = (None, None)
+            elif items[1] == 'D': hPos_val = ('D', 'D')
+            else: hPos_val = ( int(items[1]), int(items[2]) )
+            if items[3] == 'None': tbPos_val = (None, None)
+            elif items[3] == 'D': tbPos_val = ('D', 'D')
+            else: tbPos_val = ( int(items[3]), int(items[4]) )
+            if items[7] == 'None': h2ac_dist_val = None
+            else: h2ac_dist_val = int(items[7])
+            oData.set(idx_, 'hPos', hPos_val)
+            oData.set(idx_, 'tbPos', tbPos_val)
+            oData.set(idx_, 'h2ac_dist', h2ac_dist_val)
+    return oData
+
+# --------------------------------------------
+
+def calc_angle_diff_arr(ang1, ang2):
+    ''' array version of calc_angle_diff
+    '''
+    same_sign = ((ang1 >= 0) & (ang2 >= 0)) | ((ang1 < 0) & (ang2 < 0))
+    ad1 = np.abs(ang1) + np.abs(ang2)
+    ad2 = 180-np.abs(ang1) + 180-np.abs(ang2)
+    return np.where(same_sign, np.abs(ang1-ang2), np.minimum(ad1, ad2))
+
+# --------------------------------------------
+
+def calc_movements(oData, frame_cnt, vFPS, tagSz):
+    ''' calculates walking-distance and head-movement every half second
+    over the whole session.
+    returns WD & HM per frame (int arrays indexed by frame index) and their totals
+    '''
+    wd_arr = np.zeros(frame_cnt+1, dtype=np.int64)
+    hm_arr = np.zeros(frame_cnt+1, dtype=np.int64)
+    hsf = vFPS/2 # half second frames
+    fis = np.arange(hsf*2, frame_cnt+1, hsf) # frames of every half second (fi > hsf and fi % hsf == 0)
+    if len(fis) == 0: return wd_arr, hm_arr, 0, 0
+    h_int = oData.is_int('hPos'); t_int = oData.is_int('tbPos')
+    hXY = oData.get_xy('hPos'); tXY = oData.get_xy('tbPos')
+    hd = hXY[fis] - hXY[fis-hsf] # head tag displacement
+    td = tXY[fis] - tXY[fis-hsf] # tail tag displacement
+    hl = np.sqrt( hd[:,0]**2 + hd[:,1]**2 ) # line connecting two head tag positions
+    moved = h_int[fis] & h_int[fis-hsf] & (hl > (tagSz/2)) # all the head position info available and movement distance is not too small
+    t_avail = t_int[fis] & t_int[fis-hsf] # all the tail position info available
+    hla = np.degrees(np.arctan2( hd[:,1], hd[:,0] )) # degree of line connecting two head tag positions
+    tla = np.degrees(np.arctan2( td[:,1], td[:,0] )) # degree of line connecting two tail tag positions
+    walked = moved & t_avail & (calc_angle_diff_arr(hla, tla) < 45) # 45 degrees difference is considered as more or less similar direction to account it as 'walking'
+    head_moved = moved & ~walked # if walking didn't happen, hl is recorded as head movement
+    wd_arr[fis[walked]] = hl[walked]
+    hm_arr[fis[head_moved]] = hl[head_moved]
+    ### cumsum adds values one by one in frame order, as summing in a loop does
+    WD = 0; HM = 0
+    if walked.any(): WD = np.cumsum(hl[walked])[-1]
+    if head_moved.any(): HM = np.cumsum(hl[head_moved])[-1]
+    return wd_arr, hm_arr, WD, HM
+
+# --------------------------------------------
+
+def to_str_arr(vals, none_mask=None, deleted_mask=None):
+    ''' returns object array of strings of int values ('vals'),
+    looked up from a table instead of formatting each value.
+    where 'none_mask' or 'deleted_mask' is True, it's 'None' or 'D'.
+    '''
+    if len(vals) == 0: return np.empty(0, dtype=object)
+    min_v = int(vals.min()); max_v = int(vals.max())
+    str_tbl = np.array( [ str(v) for v in range(min_v, max_v+1) ] + ['None', 'D'], dtype=object )
+    idx_ = vals - min_v
+    if none_mask is not None: idx_[none_mask] = -2
+    if deleted_mask is not None: idx_[deleted_mask] = -1
+    return str_tbl[idx_]
+
+# --------------------------------------------
+
+def write_result_csv(csv_fp, oData, frame_cnt, vFPS, tagSz):
+    ''' writes tag positions of all frames with
+    walking-distance and head-movement calculated every half second.
+    '''
+    h_int = oData.is_int('hPos')[1:frame_cnt+1]
+    t_int = oData.is_int('tbPos')[1:frame_cnt+1]
+    nfB = np.count_nonzero(h_int & t_int) # number of frames when both tags are detected
+    nfH = np.count_nonzero(h_int & ~t_int) # number of frames when only head tag is detected
+    nfT = np.count_nonzero(~h_int & t_int) # number of frames when only tail tag is detected
+    nfN = np.count_nonzero(~h_int & ~t_int) # number of frames when no tags were detected
+    nfHI = np.count_nonzero(oData.status['hPos'][1:frame_cnt+1] == ST_INTERP) # number of frames with interpolated head tag position
+    nfTI = np.count_nonzero(oData.status['tbPos'][1:frame_cnt+1] == ST_INTERP)
+    wd_arr, hm_arr, WD, HM = calc_movements(oData, frame_cnt, vFPS, tagSz) # walking distance & head movements without walking (~ looking around)
+    cols = [ np.arange(1, frame_cnt+1) ] # frame index
+    for key in oData.tag_keys:
+        st = oData.status[key][1:frame_cnt+1]
+        xy = oData.get_xy(key)[1:frame_cnt+1]
+        for i in range(2): cols.append( to_str_arr(xy[:,i], st==ST_NONE, st==ST_DELETED) )
+    dist = oData.dist[1:frame_cnt+1]
+    cols += [ wd_arr[1:], hm_arr[1:], to_str_arr(dist, dist<0) ]
+    arr = np.empty( (frame_cnt, 16), dtype=object )
+    arr[:,1::2] = ', '
+    arr[:,15] = '\n'
+    for ci in range(8):
+        if cols[ci].dtype == object: arr[:,ci*2] = cols[ci]
+        else: arr[:,ci*2] = to_str_arr(cols[ci])
+    txt = 'frame-index, hPosX, hPosY, tbPosX, tbPosY, WD, HM, h2ac_dist\n'
+    txt += ''.join( arr.ravel().tolist() ) # one line per frame
+    txt += '------------------------------------------------------------------\n'
+    txt += 'Total walking distance, %i\n'%WD
+    txt += 'Total head movements without walking, %i\n'%HM
+    txt += '------------------------------------------------------------------\n'
+    txt += 'Number of frames when both tags are detected, %i\n'%nfB
+    txt += 'Number of frames when only head tag is detected, %i\n'%nfH
+    txt += 'Number of frames when only tail tag is detected, %i\n'%nfT
+    txt += 'Number of frames when no tags are detected, %i\n'%nfN
+    txt += 'Number of frames when head tag position is interpolated, %i\n'%nfHI
+    txt += 'Number of frames when tail tag position is interpolated, %i\n'%nfTI
+    fh = open(csv_fp, 'w')
+    fh.write(txt)
+    fh.close()
+
+# --------------------------------------------
+
+def write_result_npz(npz_fp, oData):
+    ''' writes arrays of SessionData into a binary (npz) file,
+    which is loaded much faster than the result CSV file.
+    '''
+    arrs = dict( frame_cnt = np.array(oData.frame_cnt), dist = oData.dist )
+    if oData.p_rect != None: arrs['p_rect'] = np.array(oData.p_rect, dtype=np.int32)
+    for key in oData.tag_keys:
+        arrs[key] = oData.pos[key]
+        arrs[key+'_st'] = oData.status[key]
+    tmp_fp = npz_fp + '.tmp'
+    fh = open(tmp_fp, 'wb')
+    np.savez(fh, **arrs)
+    fh.close()
+    rename(tmp_fp, npz_fp) # replace the old file only when writing is complete
+
+# --------------------------------------------
+
+def read_result_npz(npz_fp, frame_cnt):
+    ''' returns SessionData loaded from a npz file.
+    returns None when the file doesn't match with the session.
+    '''
+    try:
+        npz = np.load(npz_fp)
+        if int(npz['frame_cnt']) != frame_cnt: return None
+        oData = SessionData(frame_cnt)
+        oData.dist[:] = npz['dist']
+        if 'p_rect' in npz.files: oData.p_rect = [ int(v) for v in npz['p_rect'] ]
+        for key in oData.tag_keys:
+            oData.pos[key][:] = npz[key]
+            oData.status[key][:] = npz[key+'_st']
+        npz.close()
+    except Exception: # broken or old file
+        return None
+    return oData
+
+# --------------------------------------------
+
+def load_result(base_fp, frame_cnt, journal=False):
+    ''' returns SessionData of a session.
+    autosaved data (<base_fp>.autosave.npz) is used when it exists.
+    otherwise, <base_fp>.npz is used when it's not older than <base_fp>.csv,
+    or <base_fp>.csv is read.
+    edits in the journal are replayed on top of it.
+    journal: attach a new EditJournal to the returned SessionData
+    '''
+    csv_fp = base_fp + '.csv'
+    npz_fp = base_fp + '.npz'
+    oData = None
+    if path.isfile(base_fp + '.autosave.npz') == True:
+        oData = read_result_npz(base_fp + '.autosave.npz', frame_cnt)
+    if oData == None and path.isfile(npz_fp) == True:
+        if path.isfile(csv_fp) == False or path.getmtime(npz_fp) >= path.getmtime(csv_fp):
+            oData = read_result_npz(npz_fp, frame_cnt)
+    if oData == None: oData = read_result_csv(csv_fp, frame_cnt)
+    replay_journal(oData, base_fp)
+    if journal == True: oData.journal = EditJournal(base_fp)
+    return oData
+
+# --------------------------------------------
+
+def save_result(base_fp, oData, frame_cnt, vFPS, tagSz):
+    ''' writes <base_fp>.csv and its binary sidecar, <base_fp>.npz.
+    journal and autosaved data are cleared, as all the edits are saved.
+    '''
+    sd = oData.snapshot()
+    write_result_csv(base_fp + '.csv', sd, frame_cnt, vFPS, tagSz)
+    write_result_npz(base_fp + '.npz', sd) # written after CSV, so that it's not older than CSV
+    if oData.journal != None:
+        oData.journal.remove_old()
+        if path.isfile(oData.journal.autosave_fp) == True: remove(oData.journal.autosave_fp)
+
+# --------------------------------------------
+
+def compact_result(oData):
+    ''' compact the journal of 'oData' into its autosave file.
+    this can run in a background thread, while 'oData' is being edited.
+    '''
+    if oData.journal == None: return
+    sd = oData.snapshot()
+    write_result_npz(oData.journal.autosave_fp, sd)
+    oData.journal.remove_old()
+
+# --------------------------------------------
@@ -0,0 +1,103 @@
+from time import time
+from collections import deque
+from threading import Lock
+
+import numpy as np
+
+from modules.base_funcs import get_time_stamp, writeFile
+
+stages = ['decode', 'hsv', 'contours', 'overlay', 'encode', 'bitmap', 'display'] # stages of the frame pipeline, in order
+
+# ======================================================
+
+class StageTimer:
+    ''' Records how long each stage of the frame pipeline takes.
+    The last 'window' durations of each stage are kept for rolling percentiles,
+    and count/ total/ max over the whole session for the report.
+    Stages can be recorded from any thread.
+    usage) t0 = time(); (do something); stage_timer.add('hsv', t0)
+    '''
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = Lock()
+        self.reset()
+
+    # --------------------------------------------------
+
+    def reset(self):
+        self.lock.acquire()
+        self.samples = {} # key: stage, value: deque of recent durations (seconds)
+        self.count = {}
+        self.total = {}
+        self.max = {}
+        self.start_time = time()
+        self.lock.release()
+
+    # --------------------------------------------------
+
+    def add(self, stage, t0):
+        ''' record the duration since 't0' for 'stage'
+        returns the current time, which can be 't0' of the next stage
+        '''
+        t1 = time()
+        dur = t1 - t0
+        self.lock.acquire()
+        if stage not in self.samples:
+            self.samples[stage] = deque(maxlen=self.window)
+            self.count[stage] = 0
+            self.total[stage] = 0.0
+            self.max[stage] = 0.0
+        self.samples[stage].append(dur)
+        self.count[stage] += 1
+        self.total[stage] += dur
+        if dur > self.max[stage]: self.max[stage] = dur
+        self.lock.release()
+        return t1
+
+    # --------------------------------------------------
+
+    def get_stages(self):
+        ''' returns recorded stages in pipeline order
+        '''
+        recorded = self.samples.keys()
+        return [ s_ for s_ in stages if s_ in recorded ] + sorted([ s_ for s_ in recorded if s_ not in stages ])
+
+    # --------------------------------------------------
+
+    def percentiles(self, stage, q=[50, 90, 99]):
+        ''' returns percentiles (milliseconds) of recent durations of 'stage'
+        '''
+        self.lock.acquire()
+        arr = np.array(self.samples.get(stage, []), dtype=np.float64) * 1000
+        self.lock.release()
+        if len(arr) == 0: return [0.0] * len(q)
+        return list(np.percentile(arr, q))
+
+    # --------------------------------------------------
+
+    def summary(self):
+        ''' returns one line summary; median and 90th percentile (ms) of each stage
+        '''
+        items = []
+        for s_ in self.get_stages():
+            p50, p90 = self.percentiles(s_, [50, 90])
+            items.append( '%s %.1f/%.1f'%(s_, p50, p90) )
+        return 'ms(p50/p90): ' + ', '.join(items)
+
+    # --------------------------------------------------
+
+    def write_report(self, fp, title=''):
+        ''' write timing report of the session into 'fp'
+        '''
+        txt = '# Timing report, %s\n'%(get_time_stamp())
+        if title != '': txt += '# %s\n'%(title)
+        txt += '# elapsed: %.1f seconds\n'%(time()-self.start_time)
+        txt += '# p50, p90, p99 are of the last %i samples of each stage\n'%(self.window)
+        txt += 'stage, count, total(s), mean(ms), p50(ms), p90(ms), p99(ms), max(ms)\n'
+        for s_ in self.get_stages():
+            p50, p90, p99 = self.percentiles(s_)
+            mean_ = self.total[s_] / max(1, self.count[s_]) * 1000
+            txt += '%s, %i, %.3f, %.3f, %.3f, %.3f, %.3f, %.3f\n'%(s_, self.count[s_], self.total[s_], mean_, p50, p90, p99, self.max[s_]*1000)
+        writeFile(fp, txt, mode='w')
+
+# ======================================================
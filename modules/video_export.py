@@ -0,0 +1,151 @@
+import argparse
+from sys import argv
+from time import time
+from threading import Thread, Condition
+
+import cv2
+
+from modules.cv_proc import VideoWriterThread
+from modules.batch_proc import BatchProc, get_session_folders
+from modules.session_data import load_result, ST_HELD
+from modules.frame_src import open_frame_src, get_video_out_path
+
+# ======================================================
+
+class VideoExport:
+    ''' Rebuilds the annotated video (<fPath>.avi) of a session
+    from its frames and the saved results (<fPath>.npz or <fPath>.csv),
+    without tracking; e.g. after tracking with --no-render or after editing in the GUI.
+    Frames are decoded, annotated (CVProc.draw_overlay) and resized
+    in chunks of consecutive frames by several threads, each with its own frame source.
+    Chunks are written into the video in order by one writer thread.
+    With several arenas (see Arena), overlays of all the arenas are drawn.
+    The arena rect saved in <fPath>.npz is used (default or the arena's rect with CSV only).
+    '''
+    def __init__(self, fPath, n_threads=4, chunk_sz=64, arenas_fp=None):
+        self.bp = BatchProc(fPath, arenas_fp=arenas_fp) # parent of CVProc, carrying oData, tagSz, ..
+        self.n_threads = n_threads
+        self.chunk_sz = chunk_sz # number of frames of a chunk
+        self.max_ahead = n_threads * 2 # chunks rendered ahead of the one being written; bounds memory
+        self.cond = Condition()
+
+    # --------------------------------------------------
+
+    def run(self):
+        ''' returns False when the session has no frames
+        '''
+        bp = self.bp
+        frame_src = open_frame_src(bp.src_path)
+        bp.frame_cnt = frame_src.frame_cnt
+        if bp.frame_cnt == 0:
+            print 'No frame images in %s'%(bp.src_path)
+            frame_src.release()
+            return False
+        img = frame_src.read(1)
+        frame_src.release()
+        for t_ in bp.get_targets():
+            t_.frame_cnt = bp.frame_cnt
+            t_.oData = load_result(t_.fPath, bp.frame_cnt)
+            if t_.oData.p_rect != None: t_.cv_proc.p_rect = list(t_.oData.p_rect) # arena might have been adjusted in the GUI
+        bp.stage_timer.reset()
+        start_time = time()
+        self.video_fSize = (int(img.shape[1]/2), int(img.shape[0]/2)) # output video frame size, as in tracking
+        video_rec = VideoWriterThread( get_video_out_path(bp.src_path), bp.cv_proc.fourcc, bp.vFPS, self.video_fSize, stage_timer=bp.stage_timer )
+        self.n_chunks = (bp.frame_cnt-1) / self.chunk_sz + 1
+        self.next_chunk = 0 # chunk to be rendered next
+        self.written = 0 # number of chunks written so far
+        self.chunks = {} # rendered chunks; key: chunk index
+        self.error = None
+        ths = []
+        for i in range(min(self.n_threads, self.n_chunks)):
+            ths.append( Thread(target=self.render_chunks) )
+            ths[-1].start()
+        for ci in xrange(self.n_chunks):
+            self.cond.acquire()
+            while ci not in self.chunks and self.error == None: self.cond.wait()
+            frames = self.chunks.pop(ci, [])
+            self.written = ci + 1
+            self.cond.notify_all()
+            self.cond.release()
+            if self.error != None: break
+            for frame_arr in frames: video_rec.write(frame_arr)
+        for th in ths: th.join()
+        video_rec.release()
+        if self.error != None: raise self.error
+        print '%s: video is made. %i frames in %.1f seconds'%(bp.sString, bp.frame_cnt, time()-start_time)
+        return True
+
+    # --------------------------------------------------
+
+    def render_chunks(self):
+        ''' render chunks one after another until all the chunks are taken
+        '''
+        frame_src = open_frame_src(self.bp.src_path)
+        try:
+            while True:
+                self.cond.acquire()
+                while self.next_chunk < self.n_chunks and self.next_chunk >= self.written + self.max_ahead and self.error == None:
+                    self.cond.wait() # writing falls behind
+                ci = self.next_chunk
+                self.next_chunk += 1
+                self.cond.release()
+                if ci >= self.n_chunks or self.error != None: break
+                frames = self.render(frame_src, ci)
+                self.cond.acquire()
+                self.chunks[ci] = frames
+                self.cond.notify_all()
+                self.cond.release()
+        except Exception, e: # stop the other threads as well
+            self.cond.acquire()
+            self.error = e
+            self.cond.notify_all()
+            self.cond.release()
+        frame_src.release()
+
+    # --------------------------------------------------
+
+    def render(self, frame_src, ci):
+        ''' returns annotated and resized frames of a chunk ('ci')
+        '''
+        bp = self.bp
+        frames = []
+        fi1 = ci * self.chunk_sz + 1
+        for fi in xrange(fi1, min(fi1+self.chunk_sz, bp.frame_cnt+1)):
+            t0 = time()
+            img = frame_src.read(fi)
+            t0 = bp.stage_timer.add('decode', t0)
+            for t_ in bp.get_targets():
+                tPos = [ t_.oData[fi]['hPos'], t_.oData[fi]['tbPos'] ]
+                failed = ST_HELD in [ t_.oData.status['hPos'][fi], t_.oData.status['tbPos'][fi] ] # a tag was not found in tracking (as in proc_img)
+                t_.cv_proc.draw_overlay(img, fi, tPos, t_.oData[fi]['h2ac_dist'], failed)
+            frames.append( cv2.resize(img, self.video_fSize) )
+            bp.stage_timer.add('overlay', t0)
+        return frames
+
+# ======================================================
+
+def run_export(args):
+    ''' make the annotated video of each session (folder or video file) given as an argument
+    from its saved results
+    e.g.) python ama.py --export /data/287_Sh_1
+          python ama.py --export -j 8 '/data/*_Sh_*'
+    '''
+    parser = argparse.ArgumentParser(prog='ama.py --export')
+    parser.add_argument('folders', nargs='+', help='session folders, video files or glob patterns')
+    parser.add_argument('-j', '--threads', type=int, default=4, help='number of threads decoding and annotating frames')
+    parser.add_argument('--arenas', default=None, help='plist file of arenas, with which the session was tracked')
+    args = parser.parse_args(args)
+    folders = get_session_folders(args.folders)
+    if len(folders) == 0:
+        print 'No session folder found.'
+        return
+    cv2.setNumThreads(1) # parallelism comes from the threads
+    for fPath in folders:
+        try: VideoExport(fPath, max(1, args.threads), arenas_fp=args.arenas).run()
+        except Exception, e: # one broken session should not stop the others
+            print '%s: failed (%s)'%(fPath, str(e))
+
+# ======================================================
+
+if __name__ == '__main__':
+    run_export(argv[1:])
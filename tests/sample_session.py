@@ -0,0 +1,32 @@
+''' Sessions made of sample_data frames for the tests.
+'''
+import shutil
+from os import path, mkdir
+from glob import glob
+
+import cv2
+import numpy as np
+
+SAMPLE_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'sample_data')
+SAMPLE_VIDEO = path.join(path.dirname(SAMPLE_DIR), 'ama_sample_video.mp4')
+
+# --------------------------------------------------
+
+def make_session(dst_dir, name='287_Sh_1', n_frames=100, shifts={}):
+    ''' copy the first 'n_frames' sample frames into <dst_dir>/<name>.
+    shifts: frames to be shifted; key: frame index, value: (dx, dy)
+    returns the session folder path
+    '''
+    fPath = path.join(dst_dir, name)
+    mkdir(fPath)
+    fps = sorted(glob(path.join(SAMPLE_DIR, 'f*.jpg')))[:n_frames]
+    for i, fp in enumerate(fps):
+        fi = i + 1
+        dst_fp = path.join(fPath, path.basename(fp))
+        if fi in shifts:
+            img = cv2.imread(fp)
+            m_ = np.float32( [[1, 0, shifts[fi][0]], [0, 1, shifts[fi][1]]] )
+            cv2.imwrite(dst_fp, cv2.warpAffine(img, m_, (img.shape[1], img.shape[0]), borderMode=cv2.BORDER_REPLICATE), [cv2.IMWRITE_JPEG_QUALITY, 100])
+        else:
+            shutil.copy(fp, dst_fp)
+    return fPath
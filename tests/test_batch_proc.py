@@ -0,0 +1,74 @@
+import unittest
+import tempfile
+import shutil
+import plistlib
+from os import path, listdir
+
+from modules.batch_proc import BatchProc, run_batch, get_session_folders
+from modules.cv_proc import tag_colors
+from tests.sample_session import make_session
+
+# ======================================================
+
+class TestSessionFolders(unittest.TestCase):
+    ''' sessions picked up by glob patterns (get_session_folders)
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    # --------------------------------------------------
+
+    def test_same_glob_twice(self):
+        ''' the output video of the first run is not taken as a session in the second run
+        '''
+        fPath = make_session(self.tmp_dir, n_frames=20)
+        pattern = path.join(self.tmp_dir, '*_Sh_*')
+        run_batch([pattern])
+        files = sorted(listdir(self.tmp_dir))
+        self.assertIn('287_Sh_1.avi', files)
+        self.assertEqual(get_session_folders([pattern]), [fPath])
+        run_batch([pattern])
+        self.assertEqual(sorted(listdir(self.tmp_dir)), files) # no seek index or video of 287_Sh_1.avi
+
+    # --------------------------------------------------
+
+    def test_video_outputs(self):
+        ''' output videos and sessions with the same result base are skipped
+        '''
+        for fn in ['X.mp4', 'X.avi', 'Y.avi', 'Y_ama.avi', 'Z.mov', 'Z.mp4']:
+            open(path.join(self.tmp_dir, fn), 'w').close()
+        folders = get_session_folders([path.join(self.tmp_dir, '*')])
+        self.assertEqual([ path.basename(fp) for fp in folders ], ['X.mp4', 'Y.avi', 'Z.mov'])
+
+# ======================================================
+
+class TestArenas(unittest.TestCase):
+    ''' arenas loaded from a plist file (load_arenas)
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    # --------------------------------------------------
+
+    def test_default_head_color(self):
+        ''' head tag color of an arena without 'head' is that of the session
+        '''
+        plist_fp = path.join(self.tmp_dir, 'arenas.plist')
+        plistlib.writePlist( dict(arenas=[ dict(name='A', rect=[15,70,470,476]),
+                                           dict(name='B', rect=[490,70,945,476], head='red') ]), plist_fp )
+        for sString, head in [('287_Sh_1', 'red'), ('291_Sh_1', 'blue')]:
+            bp = BatchProc(path.join(self.tmp_dir, sString), arenas_fp=plist_fp)
+            self.assertEqual(bp.arenas[0].cv_proc.get_HSV_range(0), tag_colors[head], sString)
+            self.assertEqual(bp.arenas[1].cv_proc.get_HSV_range(0), tag_colors['red'], sString)
+            self.assertEqual(bp.arenas[0].cv_proc.get_HSV_range(1), tag_colors['green'], sString)
+
+# ======================================================
+
+if __name__ == '__main__':
+    unittest.main()
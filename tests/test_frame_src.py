@@ -0,0 +1,69 @@
+import unittest
+import tempfile
+import shutil
+from os import path
+
+import cv2
+import numpy as np
+
+from modules.frame_src import PreviewStore, open_frame_src
+from tests.sample_session import make_session
+
+# ======================================================
+
+class TestPreviewStore(unittest.TestCase):
+    ''' JPEG compressed previews of a session
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fPath = make_session(self.tmp_dir, n_frames=50)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    # --------------------------------------------------
+
+    def build(self):
+        ps = PreviewStore(self.fPath, self.fPath, 50)
+        ps.th.join() # built completely
+        return ps
+
+    # --------------------------------------------------
+
+    def test_previews(self):
+        ''' previews are close to the downscaled frames and much smaller than them
+        '''
+        ps = self.build()
+        frame_src = open_frame_src(self.fPath)
+        for fi in [1, 24, 44]:
+            pImg = ps.get(fi)
+            self.assertEqual(pImg.shape, (ps.pSize[1], ps.pSize[0], 3))
+            img = cv2.resize(frame_src.read(int(round((fi-1)/10.0))*10+1), ps.pSize, interpolation=cv2.INTER_AREA) # nearest preview
+            self.assertTrue( np.abs(pImg.astype(np.int32)-img).mean() < 3 )
+        frame_src.release()
+        raw_sz = ps.n_slots * ps.pSize[0] * ps.pSize[1] * 3
+        self.assertTrue( path.getsize(ps.fp) < raw_sz / 5 )
+        ps.stop()
+
+    # --------------------------------------------------
+
+    def test_reopen(self):
+        ''' previews are kept for the next time; incompletely written ones are built again
+        '''
+        ps = self.build()
+        idx = np.array(ps.idx)
+        ps.stop()
+        ps = self.build()
+        self.assertTrue( (np.array(ps.idx) == idx).all() ) # nothing built again
+        ps.stop()
+        fh = open(ps.fp, 'r+b')
+        fh.truncate(idx[-1,0] + 10) # the last preview was not written completely
+        fh.close()
+        ps = self.build()
+        self.assertTrue( ps.idx[-1,0] > idx[-1,0] and ps.get(50) is not None )
+        ps.stop()
+
+# ======================================================
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import unittest
+import tempfile
+import shutil
+from os import path
+
+import cv2
+import numpy as np
+
+from modules.batch_proc import BatchProc
+from modules.session_data import load_result, ST_OK, ST_HELD, ST_INTERP, ST_MANUAL
+from modules.frame_src import open_frame_src
+from tests.sample_session import make_session
+
+# ======================================================
+
+class TestTracking(unittest.TestCase):
+    ''' tracking (CVProc.locate_tag) on sample frames
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    # --------------------------------------------------
+
+    def track(self, name, shifts={}, max_gap=0):
+        ''' track a session made of sample frames and return its results
+        '''
+        fPath = make_session(self.tmp_dir, name, shifts=shifts)
+        bp = BatchProc(fPath)
+        bp.run(progress_intv=0, max_gap=max_gap, render=False)
+        return load_result(bp.fPath, bp.frame_cnt)
+
+    # --------------------------------------------------
+
+    def test_diagonal_jump(self):
+        ''' tracking continues after the frames jump diagonally (camera shake)
+        '''
+        ref = self.track('287_Sh_1')
+        shifts = dict( [ (fi, (25,25)) for fi in [50, 51, 52] ] )
+        oData = self.track('287_Sh_2', shifts)
+        for fi in xrange(53, 101):
+            for key in ['hPos', 'tbPos']:
+                self.assertNotEqual(oData[fi][key], (-1,-1), 'frame %i, %s'%(fi, key))
+                self.assertEqual(oData[fi][key], ref[fi][key], 'frame %i, %s'%(fi, key))
+
+    # --------------------------------------------------
+
+    def test_fill_gaps(self):
+        ''' frames, in which tags were not found in tracking, are interpolated
+        '''
+        shifts = dict( [ (fi, (25,25)) for fi in [50, 51, 52] ] )
+        oData = self.track('287_Sh_1', shifts)
+        for key in ['hPos', 'tbPos']:
+            self.assertEqual( list(oData.status[key][50:53]), [ST_HELD]*3, key )
+        oData = self.track('287_Sh_2', shifts, max_gap=5)
+        for key in ['hPos', 'tbPos']:
+            self.assertEqual( list(oData.status[key][49:54]), [ST_OK]+[ST_INTERP]*3+[ST_OK], key )
+            p0 = oData[49][key]; p1 = oData[53][key]
+            for fi in [50, 51, 52]:
+                r_ = (fi-49) / 4.0
+                exp_ = ( int(round(p0[0]+(p1[0]-p0[0])*r_)), int(round(p0[1]+(p1[1]-p0[1])*r_)) )
+                self.assertEqual(oData[fi][key], exp_, 'frame %i, %s'%(fi, key))
+        cvp = BatchProc(path.join(self.tmp_dir, '287_Sh_2')).cv_proc
+        for fi in [50, 51, 52]: self.assertEqual(oData[fi]['h2ac_dist'], cvp.calc_h2ac_dist(oData[fi]['hPos'])[1])
+
+    # --------------------------------------------------
+
+    def test_propagate_backward(self):
+        ''' a manual correction is propagated backward, 
+        reading frames forward in chunks
+        '''
+        ref = self.track('287_Sh_1')
+        bp = BatchProc(path.join(self.tmp_dir, '287_Sh_1'))
+        bp.frame_cnt = 100
+        bp.oData = load_result(bp.fPath, bp.frame_cnt)
+        oData = bp.oData
+        for fi in xrange(20, 80): oData[fi]['hPos'] = (ref[fi]['hPos'][0]+40, ref[fi]['hPos'][1]) # wrong positions
+        oData.set(80, 'hPos', ref[80]['hPos'], ST_MANUAL)
+        frame_src = open_frame_src(bp.src_path)
+        read_fis = []
+        def get_frame(fi):
+            read_fis.append(fi)
+            return frame_src.read(fi)
+        changed = bp.cv_proc.propagate(80, 'hPos', get_frame, max_frames=300, chunk_sz=30)
+        frame_src.release()
+        self.assertEqual(sorted(changed), range(20, 80))
+        for fi in xrange(1, 101): self.assertEqual(oData[fi]['hPos'], ref[fi]['hPos'], 'frame %i'%(fi))
+        n_jumps = len([ i for i in xrange(1, len(read_fis)) if read_fis[i] != read_fis[i-1]+1 ])
+        self.assertTrue(n_jumps <= 4, read_fis) # one jump to each of three chunks and to the forward pass
+
+    # --------------------------------------------------
+
+    def test_reacquire_after_failure(self):
+        ''' a failed previous position (-1,-1) is searched for in the whole arena
+        '''
+        ref = self.track('287_Sh_1')
+        bp = BatchProc(make_session(self.tmp_dir, '287_Sh_2', n_frames=60))
+        frame_src = open_frame_src(bp.src_path)
+        img = frame_src.read(60)
+        frame_src.release()
+        cvp = bp.cv_proc
+        for i, key in enumerate(['hPos', 'tbPos']):
+            HSVmin, HSVmax = cvp.get_HSV_range(i)
+            color_func = lambda rect_, step: cvp.find_color(rect_, img, HSVmin, HSVmax, step)
+            cp, failed = cvp.locate_tag(color_func, (-1,-1), (-1,-1))
+            self.assertFalse(failed)
+            self.assertTrue( abs(cp[0]-ref[60][key][0]) <= 2 and abs(cp[1]-ref[60][key][1]) <= 2, '%s: %s'%(key, str(cp)) )
+
+    # --------------------------------------------------
+
+    def test_reacquire_small_tag(self):
+        ''' a tag of a few pixels (e.g. mostly hidden) is found in the whole arena
+        '''
+        bp = BatchProc(make_session(self.tmp_dir, '287_Sh_1', n_frames=1))
+        cvp = bp.cv_proc
+        HSVmin, HSVmax = cvp.get_HSV_range(0)
+        hsv_ = np.uint8( [[ [ (int(HSVmin[k])+int(HSVmax[k]))/2 for k in range(3) ] ]] )
+        tag_col = cv2.cvtColor(hsv_, cv2.COLOR_HSV2BGR)[0,0]
+        x1 = max(50, cvp.p_rect[0]); y1 = cvp.p_rect[1]
+        for sz in [2, 3]:
+            img = np.zeros( (cvp.fSize[1], cvp.fSize[0], 3), dtype=np.uint8 )
+            img[:] = 128 # grey background
+            x_, y_ = x1+201, y1+101 # off the grid of every 4th pixel
+            img[y_:y_+sz, x_:x_+sz] = tag_col
+            color_func = lambda rect_, step: cvp.find_color(rect_, img, HSVmin, HSVmax, step)
+            cp, failed = cvp.locate_tag(color_func, (-1,-1), (-1,-1))
+            self.assertFalse(failed, 'size %i'%(sz))
+            self.assertEqual(cp, (x_+sz/2, y_+sz/2), 'size %i'%(sz))
+
+    # --------------------------------------------------
+
+    def test_color_lut(self):
+        ''' tag colors classified with the lookup table (find_class) are the same as with HSV conversion (find_color)
+        '''
+        bp = BatchProc(make_session(self.tmp_dir, '287_Sh_1', n_frames=60))
+        frame_src = open_frame_src(bp.src_path)
+        cvp = bp.cv_proc
+        rect_ = (0, 0, cvp.fSize[0], cvp.fSize[1])
+        for fi in [1, 30, 60]:
+            img = frame_src.read(fi)
+            for i in range(2): # head and tail-base
+                HSVmin, HSVmax = cvp.get_HSV_range(i)
+                c_img, c_offset = cvp.find_color(rect_, img, HSVmin, HSVmax)
+                l_img, l_offset = cvp.find_class(rect_, img, 1<<i)
+                self.assertEqual(l_offset, c_offset)
+                self.assertTrue(np.array_equal(l_img > 0, c_img > 0), 'frame %i, tag %i'%(fi, i))
+        frame_src.release()
+
+# ======================================================
+
+if __name__ == '__main__':
+    unittest.main()
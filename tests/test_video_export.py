@@ -0,0 +1,80 @@
+import unittest
+import tempfile
+import shutil
+
+import cv2
+import numpy as np
+
+from modules.batch_proc import BatchProc
+from modules.video_export import VideoExport
+from modules.session_data import load_result, save_result
+from modules.frame_src import get_video_out_path
+from tests.sample_session import make_session
+
+# ======================================================
+
+class TestVideoExport(unittest.TestCase):
+    ''' rebuilding the annotated video from saved results
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    # --------------------------------------------------
+
+    def test_adjusted_arena(self):
+        ''' the arena rect saved with the results is used in export
+        '''
+        fPath = make_session(self.tmp_dir, n_frames=20)
+        bp = BatchProc(fPath)
+        bp.run(progress_intv=0, render=False)
+        oData = load_result(bp.fPath, bp.frame_cnt)
+        self.assertEqual(oData.p_rect, bp.cv_proc.p_rect)
+        p_rect = [ v+10 for v in bp.cv_proc.p_rect ] # as adjusted in the GUI
+        oData.p_rect = p_rect
+        save_result(bp.fPath, oData, bp.frame_cnt, bp.vFPS, bp.tagSz)
+        ve = VideoExport(fPath, n_threads=2, chunk_sz=8)
+        self.assertTrue(ve.run())
+        self.assertEqual(ve.bp.cv_proc.p_rect, p_rect)
+
+    # --------------------------------------------------
+
+    def read_video(self, fp):
+        ''' returns all the frames of a video file
+        '''
+        cap = cv2.VideoCapture(fp)
+        frames = []
+        while True:
+            ret, frame_arr = cap.read()
+            if ret == False: break
+            frames.append(frame_arr)
+        cap.release()
+        return frames
+
+    # --------------------------------------------------
+
+    def test_same_as_tracking(self):
+        ''' the exported video is the same as the one recorded in tracking,
+        also over a gap of frames, in which tags were not found (red arena)
+        '''
+        shifts = dict( [ (fi, (25,25)) for fi in [50, 51, 52] ] )
+        fPath = make_session(self.tmp_dir, n_frames=60, shifts=shifts)
+        bp = BatchProc(fPath)
+        bp.run(progress_intv=0)
+        video_fp = get_video_out_path(bp.src_path)
+        tracked = self.read_video(video_fp)
+        self.assertTrue(VideoExport(fPath, n_threads=2, chunk_sz=8).run()) # overwrites the video
+        exported = self.read_video(video_fp)
+        self.assertEqual(len(exported), len(tracked))
+        x_, y_ = bp.cv_proc.p_rect[0]/2, bp.cv_proc.p_rect[1]/2+20 # on the left edge of the arena rect in the half size video
+        for fi in xrange(48, 55):
+            self.assertTrue(np.array_equal(exported[fi-1], tracked[fi-1]), 'frame %i'%(fi))
+            is_red = tracked[fi-1][y_,x_,2] > 100 and tracked[fi-1][y_,x_,0] < 100
+            self.assertEqual(is_red, fi in shifts, 'frame %i'%(fi))
+
+# ======================================================
+
+if __name__ == '__main__':
+    unittest.main()